@@ -1,27 +1,116 @@
 from __future__ import annotations
 
-import argparse
+import array
 import ast
+import bisect
+import collections
+import contextlib
 import dataclasses
+import functools
+import heapq
+import io
 import os
 import pathlib
 import re
+import stat
 import sys
+import time
+from typing import TYPE_CHECKING
 from typing import Any
+from typing import Callable
 from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Mapping
 from typing import Sequence
 from typing import Tuple
+from typing import TypeVar
 
-if sys.version_info >= (3, 11):  # pragma: no cover
-    import tomllib
-else:  # pragma: no cover
-    import tomli as tomllib
+from auto_walrus_client import DAEMON_HOST
+from auto_walrus_client import DAEMON_PORT
+from auto_walrus_client import DAEMON_URL
+from auto_walrus_client import DaemonError
+from auto_walrus_client import config_header
+from auto_walrus_client import request_rewrite
+
+# Modules which only some runs need (the command-line parser, process
+# pools, the daemon, ...) are imported where they're used, so that starting
+# up for a pre-commit run on a couple of files stays fast.
+if TYPE_CHECKING:
+    import argparse
+    import concurrent.futures
+    import http.server
+
+__version__ = "0.4.1"
 
 SEP_SYMBOLS = frozenset(("(", ")", ",", ":"))
 # name, lineno, col_offset, end_lineno, end_col_offset
 Token = Tuple[str, int, int, int, int]
+# name, lineno, col_offset
+Position = Tuple[str, int, int]
+# lineno, col_offset, end_lineno, end_col_offset
+Span = Tuple[int, int, int, int]
+# assignment target (ending where the assignment ends), span of the value
+Assignment = Tuple[Token, Span]
+# name in an if-test, span of the if's body
+IfTest = Tuple[Token, Span]
+# what `_analyse_function` finds in an outermost function: (assignment, if)
+# pairs, tails of while loops, (function position, element span, test span)
+# of comprehensions
+FunctionResult = Tuple[
+    List[Tuple[Token, Token]],
+    List[Tuple[Position, Token]],
+    List[Tuple[Tuple[int, int], Span, Span]],
+]
 SIMPLE_NODE = (ast.Name, ast.Constant)
-ENDS_WITH_COMMENT = re.compile(r"#.*$")
+COMPREHENSION = (ast.ListComp, ast.SetComp, ast.GeneratorExp, ast.DictComp)
+# nodes which mean a filter's expression can't be moved into a walrus
+UNSAFE_IN_COMPREHENSION_FILTER = (
+    ast.NamedExpr,
+    ast.Await,
+    ast.Yield,
+    ast.YieldFrom,
+    ast.Lambda,
+    ast.ListComp,
+    ast.SetComp,
+    ast.DictComp,
+    ast.GeneratorExp,
+)
+# comment which stops the line it's on from being rewritten
+NO_WALRUS_COMMENT = re.compile(r"#.*\bno-walrus\b")
+# comments which only apply to the line they're on (linters' and type
+# checkers' directives, type comments), so can't be moved to another one
+PRAGMA_COMMENT = re.compile(
+    r"#\s*(?:noqa\b|type:|pragma:|pylint:|nosec\b|fmt:|mypy:|pyright:|ruff:|isort:)",
+    re.IGNORECASE,
+)
+# line breaks, as understood by the tokenizer (unlike `str.splitlines`)
+NEWLINE = re.compile(r"\r\n?|\n")
+DEF_KEYWORD = re.compile(r"\bdef\b")
+IF_KEYWORD = re.compile(r"\b(?:el)?if\b")
+IF_OR_WHILE_KEYWORD = re.compile(r"\b(?:(?:el)?if|while)\b")
+FOR_KEYWORD = re.compile(r"\bfor\b")
+IDENTIFIER = re.compile(r"\w+")
+SEMICOLON = re.compile(r"[ \t]*;[ \t]*")
+# names of variables introduced by comprehension rewrites are this, plus a
+# number if it's taken
+COMPREHENSION_NAME = "_value"
+# `name = ...` (or `(name) = ...`), matched against the *reversed* source:
+# starting from the `=` lets the regex engine skip ahead quickly
+REVERSED_ASSIGNED_NAME = re.compile(r"(?<!=)=[ \t)]*(\w+)(?![\w.])")
+# below this many files, starting worker processes costs more than it saves
+MIN_FILES_FOR_PROCESSES = 32
+CACHE_MAX_ENTRIES = 100_000
+# listing the whole cache takes a while, so `Cache.prune` does it at most
+# this often (in seconds)
+CACHE_PRUNE_INTERVAL = 24 * 60 * 60
+# analysed functions kept in memory by a `FunctionCache`
+FUNCTION_CACHE_MAX_ENTRIES = 10_000
+# threads writing rewritten files: writes are I/O-bound, so more threads than
+# CPUs help on slow (e.g. network) filesystems
+WRITE_THREADS = 8
+# number of slowest files reported by --stats
+STATS_SLOWEST = 10
 EXCLUDES = (
     r"/("
     r"\.direnv|\.eggs|\.git|\.hg|\.ipynb_checkpoints|\.mypy_cache|\.nox|\.svn|"
@@ -29,21 +118,43 @@ EXCLUDES = (
     r"_build|buck-out|build|dist|venv"
     r")/"
 )
+EXCLUDES_RE = re.compile(EXCLUDES)
+# what parsing and analysing an invalid (or very deeply nested) source raises
+SOURCE_ERRORS = (SyntaxError, ValueError, RecursionError)
+
+_T = TypeVar("_T")
+_R = TypeVar("_R")
+_K = TypeVar("_K")
 
 
 @dataclasses.dataclass
 class Config:
     line_length: int
     unsafe: bool = False
+    # also rewrite `name = value; while name: ...; name = value` loops
+    while_loops: bool = False
+    # also rewrite `[f(x) for x in xs if f(x)]` to evaluate `f(x)` only once
+    comprehensions: bool = False
+    # analyse rewritten functions again, until there's nothing left to rewrite
+    until_stable: bool = False
+
 
+@dataclasses.dataclass(frozen=True)
+class Edit:
+    """Replace part of a source with `replacement`.
+
+    Lines are numbered from 1, as in `ast`, but columns are offsets in
+    characters (not UTF-8 bytes), so the edit can be applied by slicing.
+    """
 
-def name_lineno_coloffset_iterable(
-    tokens: Iterable[Token],
-) -> list[tuple[str, int, int]]:
-    return [(i[0], i[1], i[2]) for i in tokens]
+    lineno: int
+    col_offset: int
+    end_lineno: int
+    end_col_offset: int
+    replacement: str
 
 
-def name_lineno_coloffset(tokens: Token) -> tuple[str, int, int]:
+def name_lineno_coloffset(tokens: Token) -> Position:
     return (tokens[0], tokens[1], tokens[2])
 
 
@@ -97,322 +208,2535 @@ def find_names(
     return names
 
 
-def process_if(
-    node: ast.If,
-    in_body_vars: dict[Token, set[Token]],
-) -> set[Token]:
-    _names = find_names(node.test)
-    _body_names = {_name for _body in node.body for _name in find_names(_body)}
-    for _name in _names:
-        in_body_vars[_name] = _body_names
-    return _names
+def node_start(node: ast.stmt) -> tuple[int, int]:
+    # decorators come before the `def` / `class` line
+    decorators = getattr(node, "decorator_list", None)
+    if decorators:
+        return (decorators[0].lineno, decorators[0].col_offset)
+    return (node.lineno, node.col_offset)
 
 
-def process_assign(
-    node: ast.Assign,
-    assignments: set[Token],
-    related_vars: dict[str, list[Token]],
-) -> None:
+def statements_span(nodes: Sequence[ast.stmt]) -> Span:
+    assert nodes[-1].end_lineno is not None
+    assert nodes[-1].end_col_offset is not None
+    return (*node_start(nodes[0]), nodes[-1].end_lineno, nodes[-1].end_col_offset)
+
+
+def expression_span(node: ast.expr) -> Span:
+    assert node.end_lineno is not None
+    assert node.end_col_offset is not None
+    return (node.lineno, node.col_offset, node.end_lineno, node.end_col_offset)
+
+
+def position_key(lineno: int, col_offset: int) -> int:
+    """Order-preserving single integer for a (lineno, col_offset) position."""
+    return lineno << 32 | col_offset
+
+
+@dataclasses.dataclass
+class NameIndex:
+    """Position-ordered view of the names in a function.
+
+    Built once per function so that every check is a lookup rather
+    than a scan over all names. Names are stored as columns of integers
+    rather than as `Token`s, as huge (e.g. generated) functions have
+    millions of them.
+    """
+
+    # id (see `interned`) of each name, sorted by (lineno, col_offset)
+    ids: array.array[int]
+    # `position_key` of the start of each name, in the same order
+    starts: array.array[int]
+    # identifier -> id, shared by all functions in a file
+    interned: dict[str, int]
+    # id -> ascending indices into ids
+    occurrences: dict[int, array.array[int]]
+
+    def index_range(self, span: Span) -> tuple[int, int]:
+        """Indices of the names which start within `span`."""
+        return (
+            bisect.bisect_left(self.starts, position_key(span[0], span[1])),
+            bisect.bisect_left(self.starts, position_key(span[2], span[3])),
+        )
+
+    def index_of(self, token: Token) -> int:
+        """Index of the name `token`."""
+        idx = bisect.bisect_left(self.starts, position_key(token[1], token[2]))
+        name_id = self.interned[token[0]]
+        # names only share a start in some f-strings (on Python 3.8, `a` and `c`
+        # in `f"{a:{b}}{c:{d}}"`)
+        while self.ids[idx] != name_id:
+            idx += 1
+        return idx
+
+    def occurrences_in(self, name_id: int, start: int, stop: int) -> array.array[int]:
+        """Indices of the occurrences of name `name_id` in `range(start, stop)`."""
+        occurrences = self.occurrences[name_id]
+        lo = bisect.bisect_left(occurrences, start)
+        return occurrences[lo : bisect.bisect_left(occurrences, stop, lo)]
+
+
+def build_name_index(analysis: Analysis) -> NameIndex:
+    names = analysis.name_starts
+    order = sorted(range(len(names)), key=names.__getitem__)
+    ids = array.array("i", map(analysis.name_ids.__getitem__, order))
+    occurrences: dict[int, array.array[int]] = {}
+    for idx, name_id in enumerate(ids):
+        if (_occurrences := occurrences.get(name_id)) is None:
+            _occurrences = occurrences[name_id] = array.array("i")
+        _occurrences.append(idx)
+    return NameIndex(
+        ids,
+        array.array("q", map(names.__getitem__, order)),
+        analysis.interned,
+        occurrences,
+    )
+
+
+def process_if(node: ast.If | ast.While) -> list[IfTest]:
+    body_span = statements_span(node.body)
+    return [(_name, body_span) for _name in find_names(node.test)]
+
+
+def has_continue(nodes: Iterable[ast.AST]) -> bool:
+    """Whether `nodes` contain a `continue` for the loop they're directly in."""
+    stack = list(nodes)
+    while stack:
+        node = stack.pop()
+        if isinstance(node, ast.Continue):
+            return True
+        if isinstance(node, (ast.For, ast.AsyncFor, ast.While)):
+            # a `continue` in a nested loop's `else` is for the outer loop
+            stack.extend(node.orelse)
+        elif not isinstance(
+            node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef, ast.Lambda)
+        ):
+            stack.extend(ast.iter_child_nodes(node))
+    return False
+
+
+def process_while(node: ast.While) -> tuple[list[IfTest], Assignment] | None:
+    """Tests and tail assignment of a loop which might be rewritten.
+
+    That's a loop like::
+
+        while name:
+            ...
+            name = value
+
+    without an `else` and without `continue`, which skip the tail assignment.
+    """
+    if node.orelse or len(node.body) < 2 or not is_simple_test(node.test):
+        return None
+    tail = node.body[-1]
+    if not isinstance(tail, ast.Assign) or (_tail := process_assign(tail)) is None:
+        return None
+    tests = process_if(node)
+    if not any(_test[0][0] == _tail[0][0] for _test in tests) or has_continue(node.body):
+        return None
+    return tests, _tail
+
+
+def process_assign(node: ast.Assign) -> Assignment | None:
     if len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
         target = node.targets[0]
-        assignments.add(
+        return (
             record_name_lineno_coloffset(
                 target,
                 node.end_lineno,
                 node.end_col_offset,
             ),
+            expression_span(node.value),
         )
-        related_vars[target.id] = list(find_names(node.value))
+    return None
+
+
+@dataclasses.dataclass
+class FunctionScope:
+    node: ast.FunctionDef | ast.AsyncFunctionDef
+    span: Span
+    # assignments and if-tests directly in the function's body
+    assignments: list[Assignment]
+    ifs: list[IfTest]
+    # assignments and if-tests anywhere inside the function (used in unsafe
+    # mode), as ranges of the enclosing Analysis' lists
+    nested_assignments: tuple[int, int] = (0, 0)
+    nested_ifs: tuple[int, int] = (0, 0)
+    # same, for tests of while loops which might be rewritten
+    whiles: list[IfTest] = dataclasses.field(default_factory=list)
+    nested_whiles: tuple[int, int] = (0, 0)
+
+
+@dataclasses.dataclass
+class Analysis:
+    """Everything collected from an outermost function, nested ones included."""
+
+    # identifier -> id, shared by all functions in a file
+    interned: dict[str, int] = dataclasses.field(default_factory=dict)
+    scopes: list[FunctionScope] = dataclasses.field(default_factory=list)
+    # id and `position_key` of each name, in visiting order
+    name_ids: array.array[int] = dataclasses.field(
+        default_factory=functools.partial(array.array, "i")
+    )
+    name_starts: array.array[int] = dataclasses.field(
+        default_factory=functools.partial(array.array, "q")
+    )
+    assignments: list[Assignment] = dataclasses.field(default_factory=list)
+    ifs: list[IfTest] = dataclasses.field(default_factory=list)
+    whiles: list[IfTest] = dataclasses.field(default_factory=list)
+    # value of each assignment, by the position of its target
+    values: dict[Position, ast.expr] = dataclasses.field(default_factory=dict)
+    # tail assignment of each while loop, by the position of its tests' names
+    while_tails: dict[Position, Token] = dataclasses.field(default_factory=dict)
+
+
+class ScopeCollector:
+    """Collect names, assignments and if-tests of every function in one pass.
+
+    Each node is visited once, in the same order as `ast.NodeVisitor`, but
+    with an explicit stack, as expressions can nest deeper than the
+    recursion limit. A function's nested assignments and if-tests are
+    contiguous in visiting order, so nested scopes only record where their
+    share of the enclosing lists starts and stops. Those directly in a
+    function are also added to its scope's lists (sharing the same tuples)
+    when they're visited.
+    """
+
+    def __init__(self) -> None:
+        self.analyses: list[Analysis] = []
+        self.interned: dict[str, int] = {}
+        self._depth = 0
+        # id of each not yet visited statement directly in a function -> its scope
+        self._direct: dict[int, FunctionScope] = {}
+
+    def visit(self, tree: ast.AST) -> None:
+        # nodes to visit, and functions to finish once their bodies were visited
+        stack: list[ast.AST | tuple[FunctionScope, int, int, int]] = [tree]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, tuple):
+                self._finish_function(*node)
+                continue
+            if isinstance(node, ast.Name):
+                self.visit_Name(node)
+            elif isinstance(node, ast.Assign):
+                self.visit_Assign(node)
+            elif isinstance(node, ast.If):
+                self.visit_If(node)
+            elif isinstance(node, ast.While):
+                self.visit_While(node)
+            elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                stack.append(self.visit_FunctionDef(node))
+            stack.extend(reversed(list(ast.iter_child_nodes(node))))
+
+    def visit_Name(self, node: ast.Name) -> None:  # noqa: N802
+        if self._depth:
+            analysis = self.analyses[-1]
+            if (name_id := self.interned.get(node.id)) is None:
+                name_id = self.interned[node.id] = len(self.interned)
+            analysis.name_ids.append(name_id)
+            analysis.name_starts.append(position_key(node.lineno, node.col_offset))
+
+    def visit_Assign(self, node: ast.Assign) -> None:  # noqa: N802
+        scope = self._direct.pop(id(node), None)
+        if self._depth and (_assignment := process_assign(node)) is not None:
+            analysis = self.analyses[-1]
+            analysis.assignments.append(_assignment)
+            analysis.values[name_lineno_coloffset(_assignment[0])] = node.value
+            if scope is not None:
+                scope.assignments.append(_assignment)
+
+    def visit_If(self, node: ast.If) -> None:  # noqa: N802
+        scope = self._direct.pop(id(node), None)
+        if self._depth and is_simple_test(node.test):
+            tests = process_if(node)
+            self.analyses[-1].ifs.extend(tests)
+            if scope is not None:
+                scope.ifs.extend(tests)
+
+    def visit_While(self, node: ast.While) -> None:  # noqa: N802
+        scope = self._direct.pop(id(node), None)
+        if self._depth and (_while := process_while(node)) is not None:
+            analysis = self.analyses[-1]
+            tests, (tail, _) = _while
+            # only the name which the tail assigns to can be walrused
+            tests = [_test for _test in tests if _test[0][0] == tail[0]]
+            analysis.whiles.extend(tests)
+            for _test, _ in tests:
+                analysis.while_tails[name_lineno_coloffset(_test)] = tail
+            if scope is not None:
+                scope.whiles.extend(tests)
+
+    def visit_FunctionDef(  # noqa: N802
+        self,
+        node: ast.FunctionDef | ast.AsyncFunctionDef,
+    ) -> tuple[FunctionScope, int, int, int]:
+        """Start collecting `node`'s scope.
+
+        Returns what `_finish_function` needs once its body was visited.
+        """
+        if not self._depth:
+            self.analyses.append(Analysis(self.interned))
+        analysis = self.analyses[-1]
+        scope = FunctionScope(node, statements_span([node]), [], [])
+        for _node in node.body:
+            if isinstance(_node, (ast.Assign, ast.If, ast.While)):
+                self._direct[id(_node)] = scope
+            if isinstance(_node, ast.If):
+                for __node in _node.orelse:
+                    if isinstance(__node, ast.If):
+                        self._direct[id(__node)] = scope
+        analysis.scopes.append(scope)
+        self._depth += 1
+        return scope, len(analysis.assignments), len(analysis.ifs), len(analysis.whiles)
+
+    def _finish_function(
+        self,
+        scope: FunctionScope,
+        n_assignments: int,
+        n_ifs: int,
+        n_whiles: int,
+    ) -> None:
+        self._depth -= 1
+        analysis = self.analyses[-1]
+        scope.nested_assignments = (n_assignments, len(analysis.assignments))
+        scope.nested_ifs = (n_ifs, len(analysis.ifs))
+        scope.nested_whiles = (n_whiles, len(analysis.whiles))
+
+
+def is_side_effect_free_call(node: ast.expr) -> bool:
+    """Whether `node` is a call which doesn't contain anything which binds names.
+
+    Whatever the call itself does can't be seen from here.
+    """
+    return isinstance(node, ast.Call) and not any(
+        isinstance(_node, UNSAFE_IN_COMPREHENSION_FILTER) for _node in ast.walk(node)
+    )
+
+
+def process_comprehension(
+    node: ast.ListComp | ast.SetComp | ast.GeneratorExp | ast.DictComp,
+) -> tuple[Span, Span] | None:
+    """Find an element which is repeated in the comprehension's filter.
+
+    Returns the spans of the element and of its repetition, when that's a
+    call, in the last filter (so nothing is evaluated in between) and either
+    the whole filter or the left-hand side of a comparison with simple
+    nodes. In dict comprehensions, the element may be the key or, if the key
+    is simple, the value.
+    """
+    generator = node.generators[-1]
+    if not generator.ifs:
+        return None
+    test = generator.ifs[-1]
+    if isinstance(test, ast.Compare) and all(
+        isinstance(_node, SIMPLE_NODE) for _node in test.comparators
+    ):
+        test = test.left
+    if not is_side_effect_free_call(test):
+        return None
+    test_dump = ast.dump(test)
+    if isinstance(node, ast.DictComp):
+        if ast.dump(node.key) == test_dump:
+            element = node.key
+        elif isinstance(node.key, SIMPLE_NODE):
+            element = node.value
+        else:
+            return None
+    else:
+        element = node.elt
+    if ast.dump(element) != test_dump:
+        return None
+    element_span, test_span = expression_span(element), expression_span(test)
+    if element_span[0] != element_span[2] or test_span[0] != test_span[2]:
+        return None
+    return element_span, test_span
+
+
+class ComprehensionCollector:
+    """Collect comprehensions which `process_comprehension` can rewrite.
+
+    Only comprehensions directly in a function are considered: the walrus
+    would bind a name in the enclosing scope, which isn't allowed in class
+    bodies or in other comprehensions' iterables, and would add a global at
+    module level. Nodes are visited with an explicit stack, as expressions
+    can nest deeper than the recursion limit.
+    """
+
+    def __init__(self) -> None:
+        # (position of the function, element span, test span)
+        self.comprehensions: list[tuple[tuple[int, int], Span, Span]] = []
+
+    def visit(self, tree: ast.AST) -> None:
+        # each node, with the position of the function whose body it's in, if any
+        stack: list[tuple[ast.AST, tuple[int, int] | None]] = [(tree, None)]
+        while stack:
+            node, function = stack.pop()
+            children: list[tuple[ast.AST, tuple[int, int] | None]]
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                # decorators, defaults and annotations are evaluated in the
+                # enclosing scope
+                children = [
+                    (child, function)
+                    for child in (
+                        *node.decorator_list,
+                        node.args,
+                        *filter(None, [node.returns]),
+                    )
+                ]
+                position = (node.lineno, node.col_offset)
+                children += [(child, position) for child in node.body]
+            elif isinstance(node, ast.ClassDef):
+                children = [
+                    (child, function)
+                    for child in (*node.decorator_list, *node.bases, *node.keywords)
+                ]
+                children += [(child, None) for child in node.body]
+            elif isinstance(node, ast.Lambda):
+                children = [(node.args, function), (node.body, None)]
+            elif isinstance(node, COMPREHENSION):
+                if function is not None and (
+                    _comprehension := process_comprehension(node)
+                ):
+                    self.comprehensions.append((function, *_comprehension))
+                children = [(child, None) for child in ast.iter_child_nodes(node)]
+            else:
+                children = [(child, function) for child in ast.iter_child_nodes(node)]
+            stack.extend(reversed(children))
 
 
 def is_walrussable(
-    _assignment: Token,
-    _if_statement: Token,
-    sorted_names: list[Token],
+    occurrences: Sequence[int],
     assignment_idx: int,
     if_statement_idx: int,
-    _other_assignments: list[Token],
-    _other_usages: list[Token],
-    names: set[Token],
-    in_body_vars: dict[Token, set[Token]],
+    n_assignments: int,
+    body_range: tuple[int, int],
 ) -> bool:
+    """Whether an assignment can be moved into an if-test.
+
+    `occurrences` are the indices of the assigned name in the scope.
+    """
     return (
-        # check name doesn't appear between assignment and if statement
-        _assignment[0]
-        not in [sorted_names[i][0] for i in range(assignment_idx + 1, if_statement_idx)]
         # check it's the variable's only assignment
-        and (len(_other_assignments) == 1)
+        (n_assignments == 1)
+        # check it's used at least somewhere else
+        and (len(occurrences) > 2)
         # check this is the first usage of this name
+        and (occurrences[0] == assignment_idx)
+        # check name doesn't appear between assignment and if statement
         and (
-            name_lineno_coloffset(
-                _other_usages[0],
-            )
-            == name_lineno_coloffset(_assignment)
+            bisect.bisect_left(occurrences, if_statement_idx)
+            <= bisect.bisect_right(occurrences, assignment_idx)
         )
-        # check it's used at least somewhere else
-        and (len(_other_usages) > 2)
         # check it doesn't appear anywhere else
-        and not [
-            i
-            for i in names
-            if (
-                name_lineno_coloffset(i)
-                not in name_lineno_coloffset_iterable(in_body_vars[_if_statement])
-            )
-            and (
-                name_lineno_coloffset(
-                    i,
-                )
-                != name_lineno_coloffset(_assignment)
-            )
-            and (
-                name_lineno_coloffset(
-                    i,
-                )
-                != name_lineno_coloffset(_if_statement)
-            )
-            and i[0] == _assignment[0]
-        ]
+        and all(
+            body_range[0] <= i < body_range[1] or i in (assignment_idx, if_statement_idx)
+            for i in occurrences
+        )
     )
 
 
 def related_vars_are_unused(
-    related_vars: dict[str, list[Token]],
-    name: str,
-    sorted_names: list[Token],
+    value_range: tuple[int, int],
+    index: NameIndex,
     assignment_idx: int,
     if_statement_idx: int,
 ) -> bool:
     # Check that names which appear in right hand side of
     # assignment aren't used between assignment and if-statement.
-    related = related_vars[name]
-    should_break = False
-    for rel in related:
-        usages = [i for i in sorted_names if i[0] == rel[0] if i != rel]
-        for usage in usages:
-            rel_used_idx = name_lineno_coloffset_iterable(
-                sorted_names,
-            ).index(name_lineno_coloffset(usage))
-            if assignment_idx < rel_used_idx < if_statement_idx:
-                should_break = True
-    return not should_break
-
-
-def visit_function_def(
-    node: ast.FunctionDef,
+    for rel_idx in range(*value_range):
+        usages = index.occurrences_in(
+            index.ids[rel_idx],
+            assignment_idx + 1,
+            if_statement_idx,
+        )
+        if any(i != rel_idx for i in usages):
+            return False
+    return True
+
+
+def scope_assignments(
+    analysis: Analysis,
+    scope: FunctionScope,
+    config: Config,
+) -> tuple[list[Assignment], collections.Counter[str]]:
+    """Assignments which might be rewritten, and how many there are of each name."""
+    if config.unsafe:
+        assignments = analysis.assignments[slice(*scope.nested_assignments)]
+    else:
+        assignments = scope.assignments
+    return assignments, collections.Counter(target[0] for target, _ in assignments)
+
+
+def find_walruses(
+    analysis: Analysis,
+    scope: FunctionScope,
+    index: NameIndex,
     config: Config,
 ) -> list[tuple[Token, Token]]:
-    names = set()
-    assignments: set[Token] = set()
-    ifs = set()
-    for _node in ast.walk(node):
-        if isinstance(_node, ast.Name):
-            names.add(record_name_lineno_coloffset(_node))
-
-    related_vars: dict[str, list[Token]] = {}
-    in_body_vars: dict[Token, set[Token]] = {}
-
-    for _node in ast.walk(node) if config.unsafe else node.body:
-        if isinstance(_node, ast.Assign):
-            process_assign(_node, assignments, related_vars)
-        elif isinstance(_node, ast.If):
-            if is_simple_test(_node.test):
-                ifs.update(process_if(_node, in_body_vars))
-            for __node in _node.orelse:
-                if isinstance(__node, ast.If) and is_simple_test(__node.test):
-                    ifs.update(process_if(__node, in_body_vars))
-
-    sorted_names = sorted(names, key=lambda x: (x[1], x[2]))
-    sorted_assignments = sorted(assignments, key=lambda x: (x[1], x[2]))
-    sorted_ifs = sorted(ifs, key=lambda x: (x[1], x[2]))
+    assignments, n_assignments = scope_assignments(analysis, scope, config)
+    ifs = analysis.ifs[slice(*scope.nested_ifs)] if config.unsafe else scope.ifs
+    scope_range = index.index_range(scope.span)
+    ifs_by_name: dict[str, list[IfTest]] = {}
+    for _if_test in ifs:
+        ifs_by_name.setdefault(_if_test[0][0], []).append(_if_test)
     walrus = []
 
-    for _assignment in sorted_assignments:
-        _if_statements = [i for i in sorted_ifs if i[0] == _assignment[0]]
+    for _assignment, value_span in sorted(assignments, key=lambda x: (x[0][1], x[0][2])):
+        _if_statements = ifs_by_name.get(_assignment[0], [])
         if len(_if_statements) != 1:
             continue
-        _if_statement = _if_statements[0]
-        assignment_idx = name_lineno_coloffset_iterable(
-            sorted_names,
-        ).index(name_lineno_coloffset(_assignment))
-        if_statement_idx = name_lineno_coloffset_iterable(
-            sorted_names,
-        ).index(name_lineno_coloffset(_if_statement))
-        _other_assignments = [i for i in sorted_assignments if i[0] == _assignment[0]]
-        _other_usages = [i for i in sorted_names if i[0] == _assignment[0]]
+        _if_statement, body_span = _if_statements[0]
+        assignment_idx = index.index_of(_assignment)
+        if_statement_idx = index.index_of(_if_statement)
         if is_walrussable(
-            _assignment,
-            _if_statement,
-            sorted_names,
+            index.occurrences_in(index.interned[_assignment[0]], *scope_range),
             assignment_idx,
             if_statement_idx,
-            _other_assignments,
-            _other_usages,
-            names,
-            in_body_vars,
+            n_assignments[_assignment[0]],
+            index.index_range(body_span),
         ) and related_vars_are_unused(
-            related_vars,
-            _assignment[0],
-            sorted_names,
+            index.index_range(value_span),
+            index,
             assignment_idx,
             if_statement_idx,
         ):
             walrus.append((_assignment, _if_statement))
+    if config.while_loops:
+        walrus.extend(find_while_walruses(analysis, scope, index, config))
+    return walrus
+
+
+def find_while_walruses(
+    analysis: Analysis,
+    scope: FunctionScope,
+    index: NameIndex,
+    config: Config,
+) -> list[tuple[Token, Token]]:
+    """Find loops like `name = value; while name: ...; name = value`.
+
+    The first assignment is then treated like one followed by an if
+    statement, and the tail assignment (which must have the same value)
+    is removed when rewriting.
+    """
+    if config.unsafe:
+        whiles = analysis.whiles[slice(*scope.nested_whiles)]
+    else:
+        whiles = scope.whiles
+    assignments, n_assignments = scope_assignments(analysis, scope, config)
+    scope_range = index.index_range(scope.span)
+    whiles_by_name: dict[str, list[IfTest]] = {}
+    for while_test in whiles:
+        whiles_by_name.setdefault(while_test[0][0], []).append(while_test)
+    first_assignments: dict[str, Assignment] = {}
+    for assignment in sorted(assignments, key=lambda x: (x[0][1], x[0][2])):
+        first_assignments.setdefault(assignment[0][0], assignment)
+    walrus = []
+
+    for name, _while_tests in whiles_by_name.items():
+        if len(_while_tests) != 1 or name not in first_assignments:
+            continue
+        (_while_test, body_span), (_assignment, value_span) = (
+            _while_tests[0],
+            first_assignments[name],
+        )
+        tail = analysis.while_tails[name_lineno_coloffset(_while_test)]
+        assignment_idx = index.index_of(_assignment)
+        while_test_idx = index.index_of(_while_test)
+        if (
+            is_walrussable(
+                index.occurrences_in(index.interned[name], *scope_range),
+                assignment_idx,
+                while_test_idx,
+                # in unsafe mode, the tail assignment is counted too
+                n_assignments[name] - 1 if config.unsafe else n_assignments[name],
+                index.index_range(body_span),
+            )
+            and related_vars_are_unused(
+                index.index_range(value_span),
+                index,
+                assignment_idx,
+                while_test_idx,
+            )
+            and ast.dump(analysis.values[name_lineno_coloffset(_assignment)])
+            == ast.dump(analysis.values[name_lineno_coloffset(tail)])
+        ):
+            walrus.append((_assignment, _while_test))
     return walrus
 
 
+def might_rewrite(content: str, config: Config | None = None) -> bool:
+    """Cheaply check, without parsing, whether `content` could be rewritten.
+
+    If this returns False then `auto_walrus` (with `config`) is guaranteed
+    to return None.
+    """
+    keyword = (
+        IF_OR_WHILE_KEYWORD if config is not None and config.while_loops else IF_KEYWORD
+    )
+    if DEF_KEYWORD.search(content) is None or keyword.search(content) is None:
+        return False
+    if (
+        config is not None
+        and config.comprehensions
+        and FOR_KEYWORD.search(content) is not None
+    ):
+        return True
+    if not content.isascii():
+        # identifiers are NFKC-normalised, so may not match the source text
+        return True
+    # a rewrite needs a name which is assigned to on a single line, and
+    # which is then used at least twice more (in an if-test and its body).
+    # Counting substrings may overcount, which is fine.
+    assigned = {name[::-1] for name in REVERSED_ASSIGNED_NAME.findall(content[::-1])}
+    return any(content.count(name) > 2 for name in assigned)
+
+
 def auto_walrus(
     content: str,
     config: Config,
+    *,
+    cache: FunctionCache | None = None,
 ) -> str | None:
-    lines = content.splitlines()
+    """Rewrite `content`, or return None if there's nothing to rewrite.
+
+    With a `cache`, functions which it has seen before (with the same
+    config) aren't analysed again.
+    """
+    if not might_rewrite(content, config):
+        return None
     try:
-        tree = ast.parse(content)
-    except SyntaxError:  # pragma: no cover
+        return _auto_walrus(content, config, cache=cache)[0]
+    except SOURCE_ERRORS:
         return None
 
-    walrus_set: set[tuple[Token, Token]] = set()
-    for node in ast.walk(tree):
-        if isinstance(node, ast.FunctionDef):
-            walrus_set.update(visit_function_def(node, config))
-    lines_to_remove = []
-    walruses = sorted(walrus_set, key=lambda x: (-x[1][1], -x[1][2]))
 
-    if not walruses:
-        return None
+def _rewrite_or_error(
+    content: str,
+    config: Config,
+    cache: FunctionCache | None = None,
+) -> str | None | Exception:
+    """Like `auto_walrus`, but return what's wrong with an invalid source.
 
-    for _assignment, _if_statement in walruses:
-        if _assignment[1] != _assignment[3]:
-            continue
-        txt = lines[_assignment[1] - 1][_assignment[2] : _assignment[4]]
-        if txt.count("=") > 1:
+    Sources are parsed even if `might_rewrite` rules them out, so that
+    errors in them are reported too.
+    """
+    try:
+        if not might_rewrite(content, config):
+            ast.parse(content)
+            return None
+        return _auto_walrus(content, config, cache=cache)[0]
+    except SOURCE_ERRORS as exc:
+        return exc
+
+
+def auto_walrus_many(
+    items: Iterable[tuple[_K, str]],
+    config: Config,
+    *,
+    jobs: int = 1,
+    max_in_flight: int | None = None,
+) -> Iterator[tuple[_K, str | None | Exception]]:
+    """Rewrite many sources, like calling `auto_walrus` on each of them.
+
+    `items` is an iterable of `(key, content)` pairs, which is consumed
+    lazily. For each of them, `(key, result)` is yielded, in the same order,
+    where `result` is the rewritten content, `None` if there's nothing to
+    rewrite, or the exception (e.g. `SyntaxError`) raised while processing
+    it. Every source is parsed, so errors are reported even in sources which
+    can't contain anything to rewrite.
+
+    With `jobs > 1`, items are processed in that many worker processes, with
+    at most `max_in_flight` (by default, `4 * jobs`) items submitted but not
+    yet yielded at any time, so memory use stays bounded.
+    """
+    jobs = _max_jobs(jobs)
+    if jobs <= 1:
+        for key, content in items:
+            yield key, _rewrite_or_error(content, config)
+        return
+    if max_in_flight is None:
+        max_in_flight = 4 * jobs
+    max_in_flight = max(max_in_flight, 1)
+    import concurrent.futures
+
+    in_flight: collections.deque[
+        tuple[_K, concurrent.futures.Future[str | None | Exception]]
+    ] = collections.deque()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        for key, content in items:
+            if len(in_flight) >= max_in_flight:
+                done_key, future = in_flight.popleft()
+                yield done_key, future.result()
+            in_flight.append((key, executor.submit(_rewrite_or_error, content, config)))
+        while in_flight:
+            done_key, future = in_flight.popleft()
+            yield done_key, future.result()
+
+
+def _auto_walrus(
+    content: str,
+    config: Config,
+    stats: Stats | None = None,
+    cache: FunctionCache | None = None,
+) -> tuple[str | None, list[tuple[Token, Token]]]:
+    """Rewrite `content`, also returning the (assignment, if) pairs used.
+
+    With `config.until_stable`, the outermost functions which were rewritten
+    are parsed and analysed again, on their own, until nothing changes. The
+    positions of pairs used in later passes are then in the source as it
+    was before that pass.
+
+    Raises `SyntaxError` if `content` can't be parsed.
+    """
+    if stats is None:
+        stats = Stats()
+    with stats.timer("parse"):
+        trees = [ast.parse(content)]
+    rewrites: list[tuple[Token, Token]] = []
+    # each pass removes an assignment or rewrites a comprehension, so this
+    # can't go on forever
+    while True:
+        with stats.timer("analyse"):
+            walrus_set, tails, comprehensions = _analyse(trees, config, content, cache)
+        with stats.timer("rewrite"):
+            edits, applied = _walrus_edits(
+                content, walrus_set, config, tails, comprehensions
+            )
+            if not applied:
+                break
+            rewrites.extend(applied)
+            new_content = apply_edits(content, edits)
+        if not config.until_stable:
+            return new_content, rewrites
+        with stats.timer("parse"):
+            trees = _parse_changed_functions(new_content, trees, edits)
+        content = new_content
+    if not rewrites:
+        return None, []
+    return content, rewrites
+
+
+def _parse_changed_functions(
+    content: str,
+    trees: list[ast.Module],
+    edits: list[Edit],
+) -> list[ast.Module]:
+    """Parse the outermost functions in `trees` which `edits` changed, again.
+
+    `content` is the source after `edits`. Each function is parsed on its
+    own, and its line numbers are then shifted to where it is in `content`.
+    """
+    deleted = [edit.lineno for edit in edits if edit.end_lineno > edit.lineno]
+    edited = sorted({edit.lineno for edit in edits})
+    line_starts = _line_starts(content)
+    changed = []
+    for node in _outermost_functions(trees):
+        start, _ = node_start(node)
+        assert node.end_lineno is not None
+        end = node.end_lineno
+        if bisect.bisect_left(edited, start) == bisect.bisect_right(edited, end):
             continue
-        line = lines[_if_statement[1] - 1]
-        left_bit = line[: _if_statement[2]]
-        right_bit = line[_if_statement[4] :]
-        no_paren = any(left_bit.endswith(i) for i in SEP_SYMBOLS) and any(
-            right_bit.startswith(i) for i in SEP_SYMBOLS
-        )
-        replace = txt.replace("=", ":=")
-        if no_paren:
-            line_with_walrus = left_bit + replace + right_bit
+        # lines removed before (and within) the function move it up
+        start -= bisect.bisect_left(deleted, start)
+        end -= bisect.bisect_right(deleted, end)
+        segment = content[
+            line_starts[start - 1] : (
+                line_starts[end] if end < len(line_starts) else len(content)
+            )
+        ]
+        if node.col_offset:
+            # e.g. a method: put it in a block, so its indentation is valid
+            tree = ast.parse(f"if True:\n{segment}")
+            ast.increment_lineno(tree, start - 2)
         else:
-            line_with_walrus = left_bit + "(" + replace + ")" + right_bit
-        if len(line_with_walrus) > config.line_length:
-            # don't rewrite if it would split over multiple lines
-            continue
-        # replace assignment
-        line_without_assignment = (
-            f"{lines[_assignment[1] - 1][: _assignment[2]]}"
-            f"{lines[_assignment[1] - 1][_assignment[4] :]}"
-        )
-        if (ENDS_WITH_COMMENT.search(lines[_assignment[1] - 1]) is not None) or (
-            ENDS_WITH_COMMENT.search(lines[_if_statement[1] - 1]) is not None
-        ):
-            continue
-        lines[_assignment[1] - 1] = line_without_assignment
-        # add walrus
-        lines[_if_statement[1] - 1] = line_with_walrus
-        # remove empty line
-        if not lines[_assignment[1] - 1].strip():
-            lines_to_remove.append(_assignment[1] - 1)
-
-    newlines = [
-        line
-        for i, line in enumerate(
-            lines,
-        )
-        if i not in lines_to_remove
-    ]
-    newcontent = "\n".join(newlines)
-    if newcontent and content.endswith("\n"):
-        newcontent += "\n"
-    if newcontent != content:
-        return newcontent
-    return None
+            tree = ast.parse(segment)
+            ast.increment_lineno(tree, start - 1)
+        changed.append(tree)
+    return changed
 
 
-def _get_config(paths: list[pathlib.Path]) -> dict[str, Any]:
-    """Get the configuration from a config file.
+def _outermost_functions(
+    trees: Iterable[ast.AST],
+) -> list[ast.FunctionDef | ast.AsyncFunctionDef]:
+    functions = []
+    stack = list(trees)
+    while stack:
+        for node in ast.iter_child_nodes(stack.pop()):
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                functions.append(node)
+            else:
+                stack.append(node)
+    return functions
 
-    Search for a pyproject.toml in common parent directories
-    of the given list of paths.
+
+def _analyse(
+    trees: Iterable[ast.Module],
+    config: Config,
+    content: str | None = None,
+    cache: FunctionCache | None = None,
+) -> tuple[
+    set[tuple[Token, Token]],
+    dict[Position, Token],
+    list[tuple[tuple[int, int], Span, Span]],
+]:
+    """Find what could be rewritten in `trees` (parts of the same source).
+
+    Returns the (assignment, if) pairs, the tails of while loops and the
+    comprehensions, as taken by `_walrus_edits`. With a `cache` and the
+    source, `content`, outermost functions whose source and config were
+    seen before aren't analysed again.
     """
-    root = pathlib.Path(os.path.commonpath(paths))
-    root = root.parent if root.is_file() else root
+    walrus_set: set[tuple[Token, Token]] = set()
+    tails: dict[Position, Token] = {}
+    comprehensions: list[tuple[tuple[int, int], Span, Span]] = []
+    line_starts = [] if content is None or cache is None else _line_starts(content)
+    for node in _outermost_functions(trees):
+        if content is None or cache is None:
+            result = _analyse_function(node, config)
+        else:
+            start, _ = node_start(node)
+            assert node.end_lineno is not None
+            end = node.end_lineno
+            key = cache.key(
+                content[
+                    line_starts[start - 1] : (
+                        line_starts[end] if end < len(line_starts) else len(content)
+                    )
+                ],
+                config,
+            )
+            # results are cached relative to the function's first line, so
+            # they stay valid when lines are added or removed above it
+            if (cached := cache.get(key)) is None:
+                result = _analyse_function(node, config)
+                cache.put(key, _shift(result, 1 - start))
+            else:
+                result = _shift(cached, start - 1)
+        walruses, _tails, _comprehensions = result
+        walrus_set.update(walruses)
+        tails.update(_tails)
+        comprehensions.extend(_comprehensions)
+    return walrus_set, tails, comprehensions
 
-    while root != root.parent:
-        config_file = root / "pyproject.toml"
-        if config_file.is_file():
-            config = tomllib.loads(config_file.read_text())
-            config = config.get("tool", {}).get("auto-walrus", {})
-            if config:
-                return config
 
-        root = root.parent
+def _analyse_function(
+    node: ast.FunctionDef | ast.AsyncFunctionDef,
+    config: Config,
+) -> FunctionResult:
+    """Find what could be rewritten in an outermost function."""
+    collector = ScopeCollector()
+    collector.visit(node)
+    (analysis,) = collector.analyses
+    index = build_name_index(analysis)
+    walruses = [
+        pair
+        for scope in analysis.scopes
+        for pair in find_walruses(analysis, scope, index, config)
+    ]
+    tails = list(analysis.while_tails.items()) if config.while_loops else []
+    if not config.comprehensions:
+        return walruses, tails, []
+    comprehension_collector = ComprehensionCollector()
+    comprehension_collector.visit(node)
+    return walruses, tails, comprehension_collector.comprehensions
 
-    return {}
 
+def _shift(result: FunctionResult, lines: int) -> FunctionResult:
+    """Move the positions in `result` down by `lines`.
 
-def main(argv: Sequence[str] | None = None) -> int:  # pragma: no cover
-    parser = argparse.ArgumentParser()
-    parser.add_argument("paths", nargs="+", metavar="path")
-    parser.add_argument(
-        "--files",
-        help="Regex pattern with which to match files to include",
-        required=False,
-        default=r"",
-    )
-    parser.add_argument(
-        "--exclude",
-        help="Regex pattern with which to match files to exclude",
-        required=False,
-        default=r"^$",
-    )
-    parser.add_argument(
-        "--unsafe",
-        action="store_true",
-        help="Also process if statements inside other blocks (like for loops)",
+    This also turns lists (e.g. read back from JSON) into tuples.
+    """
+
+    def token(token: Sequence[Any]) -> Token:
+        name, lineno, col_offset, end_lineno, end_col_offset = token
+        return name, lineno + lines, col_offset, end_lineno + lines, end_col_offset
+
+    def span(span: Sequence[int]) -> Span:
+        lineno, col_offset, end_lineno, end_col_offset = span
+        return lineno + lines, col_offset, end_lineno + lines, end_col_offset
+
+    walruses, tails, comprehensions = result
+    return (
+        [(token(assignment), token(if_test)) for assignment, if_test in walruses],
+        [
+            ((name, lineno + lines, col_offset), token(tail))
+            for (name, lineno, col_offset), tail in tails
+        ],
+        [
+            ((lineno + lines, col_offset), span(element), span(test))
+            for (lineno, col_offset), element, test in comprehensions
+        ],
     )
-    # black formatter's default
-    parser.add_argument("--line-length", type=int, default=88)
-    args = parser.parse_args(argv)
-    paths = [pathlib.Path(path).resolve() for path in args.paths]
 
-    # Update defaults from pyproject.toml if present
-    defaults = {k.replace("-", "_"): v for k, v in _get_config(paths).items()}
-    parser.set_defaults(**defaults)
-    args = parser.parse_args(argv)
 
-    ret = 0
+def auto_walrus_edits(
+    tree: ast.Module,
+    lines: Sequence[str],
+    config: Config,
+) -> list[Edit]:
+    """Edits which `auto_walrus` would make, without parsing the source again.
 
-    config = Config(line_length=args.line_length, unsafe=args.unsafe)
-    for path in paths:
-        if path.is_file():
-            filepaths = iter((path,))
-        else:
-            filepaths = (
-                p
-                for p in path.rglob("*")
-                if re.search(args.files, p.as_posix(), re.VERBOSE)
-                and not re.search(args.exclude, p.as_posix(), re.VERBOSE)
-                and not re.search(EXCLUDES, p.relative_to(path).as_posix())
-                and p.suffix == ".py"
-            )
+    `tree` is the parsed source, and `lines` are its lines, with their line
+    endings (e.g. from `source.splitlines(keepends=True)`), so that fixers
+    can share a single parse. The edits are sorted and don't overlap; apply
+    them with `apply_edits`.
+    """
+    content = "".join(lines)
+    walrus_set, tails, comprehensions = _analyse([tree], config)
+    return _walrus_edits(content, walrus_set, config, tails, comprehensions)[0]
 
-        for filepath in filepaths:
-            try:
-                with open(filepath, encoding="utf-8") as fd:
-                    content = fd.read()
-            except UnicodeDecodeError:
-                continue
-            new_content = auto_walrus(content, config)
-            if new_content is not None and content != new_content:
-                sys.stdout.write(f"Rewriting {filepath}\n")
-                with open(filepath, "w", encoding="utf-8") as fd:
-                    fd.write(new_content)
-                ret = 1
-    return ret
+
+def _line_starts(content: str) -> list[int]:
+    """Offset in `content` of the start of each line, as numbered by `ast`."""
+    return [0, *(match.end() for match in NEWLINE.finditer(content))]
+
+
+def _char_offset(line: str, col_offset: int) -> int:
+    """Convert a UTF-8 byte offset (as used by `ast`) into `line`."""
+    if line.isascii():
+        return col_offset
+    return len(line.encode("utf-8")[:col_offset].decode("utf-8", errors="replace"))
+
+
+def _find_comments(content: str) -> tuple[dict[int, int], set[int]] | None:
+    """Column of the comment on each (0-indexed) line which has one.
+
+    Also returns the lines on which a logical line ends, i.e. after which
+    nothing (apart from a comment) could be appended. Returns None if
+    `content` can't be tokenized.
+    """
+    import tokenize
+
+    comments = {}
+    logical_line_ends = set()
+    # universal newlines, so lines are numbered as by `ast`
+    readline = io.StringIO(content, newline=None).readline
+    try:
+        for token in tokenize.generate_tokens(readline):
+            if token.type == tokenize.COMMENT:
+                comments[token.start[0] - 1] = token.start[1]
+            elif token.type == tokenize.NEWLINE:
+                logical_line_ends.add(token.start[0] - 1)
+    except (tokenize.TokenError, SyntaxError):  # pragma: no cover
+        return None
+    return comments, logical_line_ends
+
+
+class LineEdits:
+    """Edits to the lines of `content`, which are only applied at the end.
+
+    Edits are kept per (0-indexed) line, as `(start, end, replacement)`
+    relative to the original line, so only the lines which are edited are
+    sliced out of `content`.
+    """
+
+    def __init__(self, content: str) -> None:
+        self.content = content
+        self.line_starts = _line_starts(content)
+        # original lines (without their newline), by index
+        self.lines: dict[int, str] = {}
+        self.edits: dict[int, list[tuple[int, int, str]]] = {}
+        # see `_find_comments`
+        self.comments: dict[int, int] = {}
+        self.logical_line_ends: set[int] = set()
+
+    def get_line(self, i: int) -> str:
+        if (line := self.lines.get(i)) is None:
+            if i + 1 < len(self.line_starts):
+                start, end = self.line_starts[i], self.line_starts[i + 1]
+                line = self.content[start:end].rstrip("\r\n")
+            else:
+                line = self.content[self.line_starts[i] :]
+            self.lines[i] = line
+        return line
+
+    def edited(self, i: int, *extra: tuple[int, int, str]) -> str:
+        """Line `i`, with its edits (and `extra` ones) applied."""
+        line = self.get_line(i)
+        for start, end, replacement in sorted(
+            [*self.edits.get(i, []), *extra], reverse=True
+        ):
+            line = line[:start] + replacement + line[end:]
+        return line
+
+    def add(self, i: int, *edits: tuple[int, int, str]) -> None:
+        self.edits.setdefault(i, []).extend(edits)
+
+    def find_comments(self, linenos: Iterable[int]) -> bool:
+        """Find the comments, if any of the lines `linenos` might have one.
+
+        Tokenizing takes longer than everything else here, and is only
+        needed to find comments, so it's skipped if none of the lines which
+        could be edited has one. Returns False if `content` can't be
+        tokenized.
+        """
+        if any("#" in self.get_line(lineno - 1) for lineno in linenos):
+            if (found := _find_comments(self.content)) is None:  # pragma: no cover
+                return False
+            self.comments, self.logical_line_ends = found
+        return True
+
+    def no_walrus(self, i: int) -> bool:
+        """Whether line `i` has a comment which stops it from being rewritten."""
+        return (comment_start := self.comments.get(i)) is not None and bool(
+            NO_WALRUS_COMMENT.match(self.get_line(i), comment_start)
+        )
+
+    @functools.cached_property
+    def identifiers(self) -> set[str]:
+        return set(IDENTIFIER.findall(self.content))
+
+    def result(self) -> list[Edit]:
+        """The edits, with lines which are left empty removed.
+
+        An empty line is removed including its newline. Everything else,
+        including newline style, is left as-is.
+        """
+        result: list[Edit] = []
+        for i in sorted(self.edits):
+            if self.edited(i).strip():
+                result.extend(
+                    Edit(i + 1, start, i + 1, end, replacement)
+                    for start, end, replacement in sorted(self.edits[i])
+                )
+            elif i + 1 < len(self.line_starts):
+                # remove empty line, including its newline
+                result.append(Edit(i + 1, 0, i + 2, 0, ""))
+            else:
+                result.append(Edit(i + 1, 0, i + 1, len(self.get_line(i)), ""))
+        return result
+
+
+def _move_comment(
+    lines: LineEdits,
+    assignment_idx: int,
+    assignment_edit: tuple[int, int, str],
+    if_idx: int,
+) -> tuple[tuple[int, int, str], list[tuple[int, int, str]]] | None:
+    """Edits which remove an assignment, and move its comment if need be.
+
+    That's the edit which removes the assignment, and the edits which add
+    its comment to the if statement's line. Returns None if the assignment
+    mustn't be rewritten.
+    """
+    if (comment_start := lines.comments.get(assignment_idx)) is None:
+        return assignment_edit, []
+    assignment_line = lines.get_line(assignment_idx)
+    comment = assignment_line[comment_start:]
+    if NO_WALRUS_COMMENT.match(comment):
+        return None
+    if lines.edited(
+        assignment_idx, assignment_edit, (comment_start, len(assignment_line), "")
+    ).strip():
+        # the comment stays with what's left of the line
+        return assignment_edit, []
+    # the assignment line is going to be removed, so move its comment to the
+    # end of the if statement's line, if that's where the if statement's
+    # (logical) line ends, and the comment doesn't only apply to the line
+    # it's on
+    if (
+        if_idx in lines.comments
+        or if_idx not in lines.logical_line_ends
+        or PRAGMA_COMMENT.search(comment)
+    ):
+        return None
+    if_line = lines.get_line(if_idx)
+    code_end = len(if_line.rstrip())
+    return (
+        (assignment_edit[0], len(assignment_line), ""),
+        [(code_end, len(if_line), f"  {comment}")],
+    )
+
+
+def _add_walrus(
+    lines: LineEdits,
+    walrus: tuple[Token, Token],
+    config: Config,
+    tails: dict[Position, Token] | None,
+) -> bool:
+    """Add the edits which apply `walrus` to `lines`, if it can be applied."""
+    _assignment, _if_statement = walrus
+    if _assignment[1] != _assignment[3]:
+        return False
+    assignment_idx = _assignment[1] - 1
+    if_idx = _if_statement[1] - 1
+    assignment_line = lines.get_line(assignment_idx)
+    if_line = lines.get_line(if_idx)
+    assignment_start = _char_offset(assignment_line, _assignment[2])
+    assignment_end = _char_offset(assignment_line, _assignment[4])
+    txt = assignment_line[assignment_start:assignment_end]
+    if txt.count("=") > 1:
+        return False
+    if_start = _char_offset(if_line, _if_statement[2])
+    if_end = _char_offset(if_line, _if_statement[4])
+    left_bit = if_line[:if_start]
+    right_bit = if_line[if_end:]
+    no_paren = any(left_bit.endswith(i) for i in SEP_SYMBOLS) and any(
+        right_bit.startswith(i) for i in SEP_SYMBOLS
+    )
+    replace = txt.replace("=", ":=")
+    if not no_paren:
+        replace = "(" + replace + ")"
+    if separator := SEMICOLON.match(assignment_line, assignment_end):
+        # `name = value; ...`: remove the separator too
+        assignment_end = separator.end()
+    if (
+        moved := _move_comment(
+            lines, assignment_idx, (assignment_start, assignment_end, ""), if_idx
+        )
+    ) is None or lines.no_walrus(if_idx):
+        return False
+    assignment_edit, comment_edits = moved
+    if_edits = [(if_start, if_end, replace), *comment_edits]
+    if len(lines.edited(if_idx, *if_edits)) > config.line_length:
+        # don't rewrite if it would split over multiple lines
+        return False
+    if tails and (tail := tails.get(name_lineno_coloffset(_if_statement))):
+        tail_idx = tail[1] - 1
+        if tail[1] != tail[3] or tail_idx in lines.comments:
+            return False
+        tail_line = lines.get_line(tail_idx)
+        tail_end = _char_offset(tail_line, tail[4])
+        if separator := SEMICOLON.match(tail_line, tail_end):
+            tail_end = separator.end()
+        # remove the tail assignment
+        lines.add(tail_idx, (_char_offset(tail_line, tail[2]), tail_end, ""))
+    # remove assignment
+    lines.add(assignment_idx, assignment_edit)
+    # add walrus
+    lines.add(if_idx, *if_edits)
+    if comment_edits:
+        lines.comments[if_idx] = len(if_line)
+    return True
+
+
+def _add_comprehension(
+    lines: LineEdits,
+    comprehension: tuple[tuple[int, int], Span, Span],
+    config: Config,
+    taken: set[str],
+) -> str | None:
+    """Add the edits which apply `comprehension` to `lines`, if it can be applied.
+
+    Returns the name of the new variable, which mustn't be in `taken`.
+    """
+    _, element, test = comprehension
+    element_idx, test_idx = element[0] - 1, test[0] - 1
+    element_line, test_line = lines.get_line(element_idx), lines.get_line(test_idx)
+    element_edit = (
+        _char_offset(element_line, element[1]),
+        _char_offset(element_line, element[3]),
+    )
+    test_edit = (_char_offset(test_line, test[1]), _char_offset(test_line, test[3]))
+    if any(
+        start < _end and _start < end
+        for i, (start, end) in ((element_idx, element_edit), (test_idx, test_edit))
+        for _start, _end, _ in lines.edits.get(i, [])
+    ):  # pragma: no cover
+        # overlaps with another rewrite (a comprehension's names are
+        # repeated, so it can't be in an assignment which gets moved)
+        return None
+    if lines.no_walrus(element_idx) or lines.no_walrus(test_idx):
+        return None
+    name = COMPREHENSION_NAME
+    n = 0
+    while name in lines.identifiers or name in taken:
+        n += 1
+        name = f"{COMPREHENSION_NAME}{n}"
+    new_edits = {
+        element_idx: [(*element_edit, name)],
+        test_idx: [(*test_edit, f"({name} := {test_line[slice(*test_edit)]})")],
+    }
+    if element_idx == test_idx:
+        new_edits[test_idx].append((*element_edit, name))
+    if any(
+        len(lines.edited(i, *_edits)) > config.line_length
+        for i, _edits in new_edits.items()
+    ):
+        return None
+    for i, _edits in new_edits.items():
+        lines.add(i, *_edits)
+    return name
+
+
+def _walrus_edits(
+    content: str,
+    walrus_set: set[tuple[Token, Token]],
+    config: Config,
+    tails: dict[Position, Token] | None = None,
+    comprehensions: Sequence[tuple[tuple[int, int], Span, Span]] = (),
+) -> tuple[list[Edit], list[tuple[Token, Token]]]:
+    """Work out the edits which apply the walruses in `walrus_set` to `content`.
+
+    For while loops, `tails` maps the position of the name in the test to
+    the assignment at the end of the loop, which is removed too.
+
+    `comprehensions` are the position of the enclosing function and the
+    spans of an element and of its repetition in a filter, as found by
+    `ComprehensionCollector`. The filter gets a walrus to a new variable
+    (unique within the function, and not otherwise used in `content`),
+    which replaces the element. They're reported as pairs of tokens with
+    the new variable's name.
+
+    Lines which are left empty are removed, including their newline.
+    Everything else, including newline style, is left as-is.
+    """
+    walruses = sorted(walrus_set, key=lambda x: (-x[1][1], -x[1][2]))
+    applied: list[tuple[Token, Token]] = []
+
+    if not walruses and not comprehensions:
+        return [], applied
+
+    lines = LineEdits(content)
+    involved = [
+        *(token[1] for walrus in walruses for token in walrus),
+        *(tail[1] for tail in (tails or {}).values()),
+        *(span[0] for _, *spans in comprehensions for span in spans),
+    ]
+    if not lines.find_comments(involved):  # pragma: no cover
+        return [], applied
+    applied.extend(
+        walrus for walrus in walruses if _add_walrus(lines, walrus, config, tails)
+    )
+
+    # names of new variables, by function
+    new_names: dict[tuple[int, int], set[str]] = {}
+    for comprehension in comprehensions:
+        taken = new_names.setdefault(comprehension[0], set())
+        if (name := _add_comprehension(lines, comprehension, config, taken)) is None:
+            continue
+        taken.add(name)
+        _, element, test = comprehension
+        applied.append(((name, *element), (name, *test)))
+
+    if not applied:
+        return [], []
+    return lines.result(), sorted(applied, key=lambda x: (x[1][1], x[1][2]))
+
+
+def apply_edits(source: str, edits: Iterable[Edit]) -> str:
+    """Apply non-overlapping `edits` (e.g. from `auto_walrus_edits`) to `source`.
+
+    Raises ValueError if any of them overlap.
+    """
+    line_starts = _line_starts(source)
+    pieces = []
+    position = 0
+    for start, end, replacement in sorted(
+        (
+            line_starts[edit.lineno - 1] + edit.col_offset,
+            line_starts[edit.end_lineno - 1] + edit.end_col_offset,
+            edit.replacement,
+        )
+        for edit in edits
+    ):
+        if start < position:
+            raise ValueError("overlapping edits")
+        pieces.append(source[position:start])
+        pieces.append(replacement)
+        position = end
+    pieces.append(source[position:])
+    return "".join(pieces)
+
+
+class Cache:
+    """On-disk record of file contents which don't need rewriting.
+
+    Each entry is an empty file named after a hash of the content and of
+    the `Config`. Entries live in an `auto-walrus` subdirectory of the
+    cache directory (which may be shared with other tools), in a directory
+    per auto-walrus version, so upgrading invalidates them. Creating and touching empty files is
+    safe with concurrent writers, and the least recently used entries are
+    evicted by `prune`. The results of analysing each file's functions (see
+    `FunctionCache`) are kept in a `functions` subdirectory, one entry per
+    file, with a budget of their own.
+    """
+
+    def __init__(self, cache_dir: pathlib.Path, config: Config) -> None:
+        # only this directory is ours to write to, and to clean up
+        self.root = cache_dir / "auto-walrus"
+        self.directory = self.root / __version__
+        self.functions_directory = self.directory / "functions"
+        self._salt = repr(dataclasses.astuple(config)).encode()
+
+    def _digest(self, data: bytes) -> str:
+        import hashlib
+
+        digest = hashlib.blake2b(self._salt, digest_size=16)
+        digest.update(data)
+        return digest.hexdigest()
+
+    def _entry(self, content: bytes) -> pathlib.Path:
+        return self.directory / self._digest(content)
+
+    def _functions_entry(self, filepath: pathlib.Path) -> pathlib.Path:
+        return self.functions_directory / self._digest(os.fsencode(filepath.absolute()))
+
+    def is_clean(self, content: bytes) -> bool:
+        try:
+            # refresh the entry, so it's evicted last
+            os.utime(self._entry(content))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def mark_clean(self, content: bytes) -> None:
+        self._make_directory()
+        self._entry(content).touch()
+
+    def read_functions(self, filepath: pathlib.Path) -> dict[str, FunctionResult]:
+        """The `FunctionCache.results` saved for `filepath` by an earlier run."""
+        import json
+
+        entry = self._functions_entry(filepath)
+        try:
+            data = json.loads(entry.read_text(encoding="utf-8"))
+            os.utime(entry)
+        except (FileNotFoundError, ValueError):
+            return {}
+        return {key: _shift(result, 0) for key, result in data.items()}
+
+    def write_functions(
+        self, filepath: pathlib.Path, results: dict[str, FunctionResult]
+    ) -> None:
+        """Save `results` for `filepath`, replacing what was saved atomically."""
+        import json
+        import tempfile
+
+        self._make_directory()
+        self.functions_directory.mkdir(exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(
+            dir=self.functions_directory, prefix=".", suffix=".tmp"
+        )
+        try:
+            with open(fd, "w", encoding="utf-8") as f:
+                json.dump(results, f, separators=(",", ":"))
+            os.replace(tmp_path, self._functions_entry(filepath))
+        except BaseException:  # pragma: no cover
+            os.unlink(tmp_path)
+            raise
+
+    def _make_directory(self) -> None:
+        if not self.directory.is_dir():
+            self.directory.mkdir(parents=True, exist_ok=True)
+            (self.root / ".gitignore").write_text("*\n")
+
+    def prune(
+        self,
+        max_entries: int = CACHE_MAX_ENTRIES,
+        interval: float = CACHE_PRUNE_INTERVAL,
+    ) -> None:
+        """Remove other versions' entries and all but `max_entries` of ours.
+
+        That's `max_entries` files which don't need rewriting, and the
+        functions of `max_entries` files. Does nothing if the cache was
+        pruned less than `interval` seconds ago.
+        """
+        import shutil
+
+        if not self.root.is_dir():
+            return
+        marker = self.root / ".pruned"
+        with contextlib.suppress(FileNotFoundError):
+            if time.time() - marker.stat().st_mtime < interval:
+                return
+        marker.touch()
+        for path in self.root.iterdir():
+            if path.is_dir() and path != self.directory:
+                shutil.rmtree(path, ignore_errors=True)
+        for directory in (self.directory, self.functions_directory):
+            _prune_directory(directory, max_entries)
+
+
+def _prune_directory(directory: pathlib.Path, max_entries: int) -> None:
+    """Remove all but the `max_entries` most recently used files in `directory`."""
+    entries = []
+    with contextlib.suppress(FileNotFoundError):
+        for entry in os.scandir(directory):
+            # unless it was removed by a concurrent run
+            with contextlib.suppress(FileNotFoundError):
+                if entry.is_file():
+                    entries.append((entry.stat().st_mtime, entry.path))
+    if len(entries) <= max_entries:
+        return
+    entries.sort()
+    for _, entry_path in entries[: len(entries) - max_entries]:
+        pathlib.Path(entry_path).unlink(missing_ok=True)
+
+
+class FunctionCache:
+    """Results of analysing outermost functions, so that unchanged ones are skipped.
+
+    Entries are keyed by a hash of the function's source (whole lines,
+    including its indentation and decorators) and of the `Config`, and the
+    positions in them are relative to the function's first line, so that
+    editing other functions doesn't invalidate them. The `max_entries` most
+    recently used are kept in memory. Entries which aren't are looked up in
+    `previous`, e.g. the `results` of an earlier run, as saved by
+    `Cache.write_functions`.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = FUNCTION_CACHE_MAX_ENTRIES,
+        previous: Mapping[str, FunctionResult] | None = None,
+    ) -> None:
+        self.max_entries = max_entries
+        self.previous = previous or {}
+        # whether any function was analysed, rather than found
+        self.changed = False
+        self._entries: collections.OrderedDict[str, FunctionResult] = (
+            collections.OrderedDict()
+        )
+
+    @staticmethod
+    def key(source: str, config: Config) -> str:
+        import hashlib
+
+        salt = repr(dataclasses.astuple(config)).encode()
+        digest = hashlib.blake2b(salt, digest_size=16)
+        digest.update(source.encode("utf-8", "surrogatepass"))
+        return digest.hexdigest()
+
+    def get(self, key: str) -> FunctionResult | None:
+        # entries may be evicted concurrently, e.g. by the daemon's threads
+        with contextlib.suppress(KeyError):
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        if (result := self.previous.get(key)) is not None:
+            self._remember(key, result)
+        return result
+
+    def put(self, key: str, result: FunctionResult) -> None:
+        self.changed = True
+        self._remember(key, result)
+
+    def results(self) -> dict[str, FunctionResult]:
+        """The entries which are in memory, i.e. the most recently used ones."""
+        return dict(self._entries)
+
+    def _remember(self, key: str, result: FunctionResult) -> None:
+        self._entries[key] = result
+        while len(self._entries) > self.max_entries:
+            with contextlib.suppress(KeyError):
+                self._entries.popitem(last=False)
+
+
+@dataclasses.dataclass
+class Stats:
+    """Counters and cumulative per-phase timings (in seconds) of a run.
+
+    Pass an instance to `main` to collect them programmatically.
+    """
+
+    timings: dict[str, float] = dataclasses.field(default_factory=dict)
+    files_processed: int = 0
+    # files skipped because the cache knew they don't need rewriting
+    files_cached: int = 0
+    # files skipped because `might_rewrite` ruled them out without parsing
+    files_prefiltered: int = 0
+    files_rewritten: int = 0
+    # (seconds, path) of the STATS_SLOWEST slowest files, as a heap
+    slowest: list[tuple[float, str]] = dataclasses.field(default_factory=list)
+
+    @contextlib.contextmanager
+    def timer(self, phase: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[phase] = (
+                self.timings.get(phase, 0.0) + time.perf_counter() - start
+            )
+
+    def add_file(self, seconds: float, path: str) -> None:
+        if len(self.slowest) < STATS_SLOWEST:
+            heapq.heappush(self.slowest, (seconds, path))
+        else:
+            heapq.heappushpop(self.slowest, (seconds, path))
+
+    def merge(self, other: Stats) -> None:
+        for phase, seconds in other.timings.items():
+            self.timings[phase] = self.timings.get(phase, 0.0) + seconds
+        self.files_processed += other.files_processed
+        self.files_cached += other.files_cached
+        self.files_prefiltered += other.files_prefiltered
+        self.files_rewritten += other.files_rewritten
+        for seconds, path in other.slowest:
+            self.add_file(seconds, path)
+
+    def report(self) -> str:
+        lines = [
+            f"files: {self.files_processed} processed, {self.files_cached} cached, "
+            f"{self.files_prefiltered} skipped without parsing, "
+            f"{self.files_rewritten} rewritten",
+            "time per phase:",
+            *(
+                f"  {phase:<10} {seconds:.4f}s"
+                for phase, seconds in sorted(
+                    self.timings.items(), key=lambda x: x[1], reverse=True
+                )
+            ),
+            "slowest files:",
+            *(f"  {seconds:.4f}s {path}" for seconds, path in sorted(self.slowest)[::-1]),
+        ]
+        return "\n".join(lines) + "\n"
+
+
+@dataclasses.dataclass
+class FileResult:
+    # whether the file was (or, if not writing, would be) rewritten
+    changed: bool = False
+    stats: Stats = dataclasses.field(default_factory=Stats)
+    # (assignment, if) pairs which were combined
+    rewrites: list[tuple[Token, Token]] = dataclasses.field(default_factory=list)
+    diff: str | None = None
+    # the rewritten file, for the parent process to write (see `_write_file`)
+    new_data: bytes | None = None
+
+
+def _unified_diff(filepath: pathlib.Path, content: str, new_content: str) -> str:
+    import difflib
+
+    diff = []
+    for line in difflib.unified_diff(
+        content.splitlines(keepends=True),
+        new_content.splitlines(keepends=True),
+        fromfile=str(filepath),
+        tofile=str(filepath),
+    ):
+        diff.append(line)
+        if not line.endswith("\n"):
+            diff.append("\n\\ No newline at end of file\n")
+    return "".join(diff)
+
+
+def _fix_file(
+    filepath: pathlib.Path,
+    config: Config,
+    cache: Cache | None = None,
+    *,
+    write: bool = True,
+    diff: bool = False,
+) -> FileResult:
+    """Work out how to rewrite `filepath`, if needed.
+
+    If `write`, the rewritten content is returned in `new_data` rather than
+    written, so that workers don't wait for the disk: see `_write_file`.
+    """
+    start = time.perf_counter()
+    result = _fix_file_contents(filepath, config, cache, write=write, diff=diff)
+    result.stats.add_file(time.perf_counter() - start, str(filepath))
+    return result
+
+
+# (path, config, cache) of a file to process
+FileJob = Tuple[pathlib.Path, Config, "Cache | None"]
+
+
+def _fix_file_job(file_job: FileJob, *, write: bool, diff: bool) -> FileResult:
+    filepath, config, cache = file_job
+    return _fix_file(filepath, config, cache, write=write, diff=diff)
+
+
+def _fix_file_contents(
+    filepath: pathlib.Path,
+    config: Config,
+    cache: Cache | None,
+    *,
+    write: bool,
+    diff: bool,
+) -> FileResult:
+    result = FileResult()
+    stats = result.stats
+    stats.files_processed = 1
+    with stats.timer("read"), open(filepath, "rb") as fd:
+        data = fd.read()
+    if cache is not None:
+        with stats.timer("cache"):
+            if cache.is_clean(data):
+                stats.files_cached = 1
+                return result
+    with stats.timer("read"):
+        try:
+            # newlines are kept as they are, so that they're written back unchanged
+            content = data.decode("utf-8")
+        except UnicodeDecodeError:
+            return result
+    with stats.timer("prefilter"):
+        prefiltered = not might_rewrite(content, config)
+    if prefiltered:
+        stats.files_prefiltered = 1
+    else:
+        functions = None
+        if cache is not None:
+            with stats.timer("cache"):
+                functions = FunctionCache(previous=cache.read_functions(filepath))
+        try:
+            new_content, result.rewrites = _auto_walrus(content, config, stats, functions)
+        except SOURCE_ERRORS:
+            new_content = None
+        if cache is not None and functions is not None and functions.changed:
+            with stats.timer("cache"):
+                cache.write_functions(filepath, functions.results())
+        if new_content is not None and content != new_content:
+            if write:
+                result.new_data = new_content.encode("utf-8")
+            if diff:
+                with stats.timer("diff"):
+                    result.diff = _unified_diff(filepath, content, new_content)
+            result.changed = True
+            stats.files_rewritten = 1
+            return result
+    if cache is not None:
+        with stats.timer("cache"):
+            cache.mark_clean(data)
+    return result
+
+
+def _write_file(filepath: pathlib.Path, data: bytes) -> None:
+    """Atomically replace the contents of `filepath` with `data`.
+
+    `data` is written to a temporary file in the same directory, which then
+    replaces `filepath`, so that an interrupted run can't leave a truncated
+    file behind. The file's permissions are kept, and if `filepath` is a
+    symlink, the file it points to is replaced instead of the link.
+    """
+    import tempfile
+
+    target = os.path.realpath(filepath)
+    mode = stat.S_IMODE(os.stat(target).st_mode)
+    directory, name = os.path.split(target)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=f".{name}.", suffix=".tmp")
+    try:
+        with open(fd, "wb") as f:
+            f.write(data)
+        os.chmod(tmp, mode)
+        os.replace(tmp, target)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def _max_jobs(jobs: int) -> int:
+    if sys.platform == "win32":  # pragma: no cover
+        # ProcessPoolExecutor's limit on Windows
+        return min(jobs, 61)
+    return jobs
+
+
+def _map(
+    func: Callable[[_T], _R],
+    items: Sequence[_T],
+    jobs: int,
+) -> Iterator[_R]:
+    """Like `map`, but spread over `jobs` processes if there's enough work.
+
+    Results are yielded in the order of `items`.
+    """
+    jobs = _max_jobs(jobs)
+    if jobs <= 1 or len(items) < MIN_FILES_FOR_PROCESSES:
+        return map(func, items)
+    return _map_in_processes(func, items, jobs)
+
+
+def _map_in_processes(
+    func: Callable[[_T], _R],
+    items: Sequence[_T],
+    jobs: int,
+) -> Iterator[_R]:
+    import concurrent.futures
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        yield from executor.map(
+            func,
+            items,
+            chunksize=max(1, len(items) // (jobs * 4)),
+        )
+
+
+def _is_included(
+    filepath: pathlib.Path,
+    root: pathlib.Path,
+    files: re.Pattern[str],
+    exclude: re.Pattern[str],
+) -> bool:
+    """Whether to process `filepath`, found under the directory `root`."""
+    return (
+        files.search(filepath.as_posix()) is not None
+        and not exclude.search(filepath.as_posix())
+        and not EXCLUDES_RE.search("/" + filepath.relative_to(root).as_posix())
+        and filepath.suffix == ".py"
+    )
+
+
+def _gitignore_regex(pattern: str) -> str:
+    """Translate a .gitignore glob into a regex."""
+    regex = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            regex.append("(?:.*/)?")
+            i += 3
+        elif pattern.startswith("**", i):
+            regex.append(".*")
+            i += 2
+        elif pattern[i] == "*":
+            regex.append("[^/]*")
+            i += 1
+        elif pattern[i] == "?":
+            regex.append("[^/]")
+            i += 1
+        elif pattern[i] == "[" and (end := pattern.find("]", i + 2)) != -1:
+            chars = pattern[i + 1 : end]
+            if chars[0] == "!":
+                chars = "^" + chars[1:]
+            regex.append(f"[{chars}]")
+            i = end + 1
+        elif pattern[i] == "\\" and i + 1 < len(pattern):
+            regex.append(re.escape(pattern[i + 1]))
+            i += 2
+        else:
+            regex.append(re.escape(pattern[i]))
+            i += 1
+    return "".join(regex)
+
+
+class GitIgnore:
+    """The patterns from one .gitignore file."""
+
+    def __init__(self, directory: str, lines: Iterable[str]) -> None:
+        # posix path of the directory the patterns are relative to, with a
+        # trailing slash
+        self.directory = directory if directory.endswith("/") else directory + "/"
+        # (regex, whether it's negated, whether it only matches directories)
+        self.patterns: list[tuple[re.Pattern[str], bool, bool]] = []
+        for line in lines:
+            pattern = line.rstrip("\n")
+            if not pattern.endswith("\\ "):
+                pattern = pattern.rstrip(" ")
+            if not pattern or pattern.startswith("#"):
+                continue
+            negated = pattern.startswith("!")
+            if negated:
+                pattern = pattern[1:]
+            dir_only = pattern.endswith("/")
+            pattern = pattern.rstrip("/")
+            if not pattern:
+                continue
+            if "/" in pattern:
+                # anchored to the .gitignore's directory
+                regex = _gitignore_regex(pattern.lstrip("/"))
+            else:
+                regex = "(?:.*/)?" + _gitignore_regex(pattern)
+            self.patterns.append(
+                (re.compile(regex + r"\Z", re.DOTALL), negated, dir_only)
+            )
+
+    @classmethod
+    def from_directory(cls, directory: str) -> GitIgnore | None:
+        try:
+            with open(os.path.join(directory, ".gitignore"), encoding="utf-8") as fd:
+                lines = fd.readlines()
+        except (OSError, UnicodeDecodeError):
+            return None
+        return cls(pathlib.PurePath(directory).as_posix(), lines)
+
+    @classmethod
+    def enclosing(cls, root: pathlib.Path) -> list[GitIgnore]:
+        """The .gitignore files which apply to `root`, from its git repository."""
+        gitignores = []
+        for directory in (root, *root.parents):
+            if directory != root and (
+                (gitignore := cls.from_directory(str(directory))) is not None
+            ):
+                gitignores.append(gitignore)
+            if (directory / ".git").exists():
+                return gitignores[::-1]
+        return []
+
+    def match(self, path: str, *, is_dir: bool) -> bool | None:
+        """Whether the posix `path` is ignored, or None if no pattern applies."""
+        if not path.startswith(self.directory):
+            return None
+        relative = path[len(self.directory) :]
+        for regex, negated, dir_only in reversed(self.patterns):
+            if (is_dir or not dir_only) and regex.match(relative):
+                return not negated
+        return None
+
+
+def _is_ignored(gitignores: Sequence[GitIgnore], path: str, *, is_dir: bool) -> bool:
+    # the innermost .gitignore which has an opinion wins
+    for gitignore in reversed(gitignores):
+        if (ignored := gitignore.match(path, is_dir=is_dir)) is not None:
+            return ignored
+    return False
+
+
+def _iter_python_files(
+    root: pathlib.Path,
+    files: re.Pattern[str],
+    exclude: re.Pattern[str],
+) -> Iterator[pathlib.Path]:
+    """Lazily yield the Python files to process under the directory `root`.
+
+    Directories which are excluded (by EXCLUDES or a .gitignore file)
+    are skipped without being entered, as are `.git` directories.
+    Entries are visited in sorted order, so the output is deterministic.
+    """
+    # paths are matched against EXCLUDES relative to `root`, from the "/"
+    # which ends `prefix`, so that excluded directories at the top level
+    # are skipped too
+    prefix = root.as_posix().rstrip("/") + "/"
+    stack = [(str(root), GitIgnore.enclosing(root))]
+    while stack:
+        directory, gitignores = stack.pop()
+        if (gitignore := GitIgnore.from_directory(directory)) is not None:
+            gitignores = [*gitignores, gitignore]
+        try:
+            entries = sorted(os.scandir(directory), key=lambda entry: entry.name)
+        except OSError:
+            continue
+        subdirectories = []
+        for entry in entries:
+            path = entry.path if os.sep == "/" else entry.path.replace(os.sep, "/")
+            if entry.is_dir(follow_symlinks=False):
+                if not (
+                    entry.name == ".git"
+                    or EXCLUDES_RE.search(path[len(prefix) - 1 :] + "/")
+                    or _is_ignored(gitignores, path, is_dir=True)
+                ):
+                    subdirectories.append(entry.path)
+            elif (
+                os.path.splitext(entry.name)[1] == ".py"
+                and entry.is_file()
+                and files.search(path) is not None
+                and not exclude.search(path)
+                and not EXCLUDES_RE.search(path[len(prefix) - 1 :])
+                and not _is_ignored(gitignores, path, is_dir=False)
+            ):
+                yield pathlib.Path(entry.path)
+        stack.extend((subdirectory, gitignores) for subdirectory in subdirectories[::-1])
+
+
+def _is_excluded(path: pathlib.Path) -> bool:
+    """Whether `_iter_python_files` would skip the file `path`.
+
+    That's if EXCLUDES or a .gitignore file excludes it or one of its
+    directories, as if it was found under the root of its git repository
+    (or, outside of one, under the current directory).
+    """
+    path = path.absolute()
+    root = next((d for d in path.parents if (d / ".git").exists()), None)
+    if root is None:
+        cwd = pathlib.Path.cwd()
+        root = cwd if cwd in path.parents else path.parent
+    prefix = root.as_posix().rstrip("/") + "/"
+    gitignores: list[GitIgnore] = []
+    for directory in reversed((path.parent, *path.parent.parents)):
+        if directory != root and root not in directory.parents:
+            continue
+        posix = directory.as_posix()
+        if directory != root and (
+            directory.name == ".git"
+            or EXCLUDES_RE.search(posix[len(prefix) - 1 :] + "/")
+            or _is_ignored(gitignores, posix, is_dir=True)
+        ):
+            return True
+        if (gitignore := GitIgnore.from_directory(posix)) is not None:
+            gitignores.append(gitignore)
+    posix = path.as_posix()
+    return bool(EXCLUDES_RE.search(posix[len(prefix) - 1 :])) or _is_ignored(
+        gitignores, posix, is_dir=False
+    )
+
+
+def _git(*args: str, cwd: pathlib.Path) -> str:
+    import subprocess
+
+    return subprocess.run(
+        ["git", *args],
+        cwd=cwd,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+
+
+def _git_changed_files(
+    paths: list[pathlib.Path],
+    rev: str | None,
+) -> list[pathlib.Path]:
+    """Files under `paths` changed since `rev`, or staged if `rev` is None.
+
+    Files which were changed since `rev` include untracked ones.
+    """
+    cwd = paths[0] if paths[0].is_dir() else paths[0].parent
+    toplevel = pathlib.Path(_git("rev-parse", "--show-toplevel", cwd=cwd).strip())
+    toplevel = toplevel.resolve()
+    pathspec = ["--", *(str(path) for path in paths)]
+    names = _git(
+        "diff",
+        "--name-only",
+        "-z",
+        "--diff-filter=d",
+        *(("--cached",) if rev is None else (rev,)),
+        *pathspec,
+        cwd=toplevel,
+    ).split("\0")
+    if rev is not None:
+        names += _git(
+            "ls-files", "--others", "--exclude-standard", "-z", *pathspec, cwd=toplevel
+        ).split("\0")
+    return sorted({toplevel / name for name in names if name})
+
+
+def _json_report(filepath: pathlib.Path, result: FileResult) -> str:
+    """Describe the changes to one file as a line of JSON."""
+    import json
+
+    keys = ("lineno", "col_offset", "end_lineno", "end_col_offset")
+    report: dict[str, Any] = {
+        "path": str(filepath),
+        "rewrites": [
+            {
+                "name": _assignment[0],
+                "assignment": dict(zip(keys, _assignment[1:])),
+                "if": dict(zip(keys, _if_statement[1:])),
+            }
+            for _assignment, _if_statement in result.rewrites
+        ],
+    }
+    if result.diff is not None:
+        report["diff"] = result.diff
+    return json.dumps(report) + "\n"
+
+
+def _read_pyproject(config_file: pathlib.Path) -> dict[str, Any]:
+    """The `[tool.auto-walrus]` table of `config_file`, if any."""
+    if sys.version_info >= (3, 11):  # pragma: no cover
+        import tomllib
+    else:  # pragma: no cover
+        import tomli as tomllib
+
+    table = tomllib.loads(config_file.read_text())
+    return table.get("tool", {}).get("auto-walrus", {})  # type: ignore[no-any-return]
+
+
+class ConfigResolver:
+    """Find the configuration which applies to each file.
+
+    That's the first non-empty `[tool.auto-walrus]` table in a
+    pyproject.toml in the file's directory or its parents, so subprojects
+    can have their own. `Config` options passed in `overrides` (i.e. on the
+    command line) take precedence over it, and `defaults` are used for
+    options it doesn't set. Lookups are memoised per directory, so each
+    pyproject.toml is parsed at most once.
+    """
+
+    def __init__(
+        self,
+        defaults: dict[str, Any] | None = None,
+        overrides: dict[str, Any] | None = None,
+    ) -> None:
+        self.defaults = {"line_length": 88, **(defaults or {})}
+        self.overrides = overrides or {}
+        self._tables: dict[pathlib.Path, dict[str, Any]] = {}
+        self._configs: dict[pathlib.Path, Config] = {}
+
+    def table(self, directory: pathlib.Path) -> dict[str, Any]:
+        """The `[tool.auto-walrus]` table which applies to `directory`."""
+        unresolved = []
+        table: dict[str, Any] = {}
+        while directory not in self._tables:
+            unresolved.append(directory)
+            config_file = directory / "pyproject.toml"
+            if config_file.is_file():
+                table = _read_pyproject(config_file)
+                if table:
+                    break
+            if directory == directory.parent:
+                break
+            directory = directory.parent
+        else:
+            table = self._tables[directory]
+        for path in unresolved:
+            self._tables[path] = table
+        return table
+
+    def config_for(self, filepath: pathlib.Path) -> Config:
+        directory = filepath.parent
+        if (config := self._configs.get(directory)) is None:
+            table = {k.replace("-", "_"): v for k, v in self.table(directory).items()}
+            options = {**self.defaults, **table, **self.overrides}
+            config = self._configs[directory] = Config(
+                **{
+                    field.name: options[field.name]
+                    for field in dataclasses.fields(Config)
+                    if field.name in options
+                }
+            )
+        return config
+
+
+def _get_config(paths: list[pathlib.Path], resolver: ConfigResolver) -> dict[str, Any]:
+    """Get the configuration from a config file.
+
+    Search for a pyproject.toml in common parent directories
+    of the given list of paths.
+    """
+    root = pathlib.Path(os.path.commonpath(paths))
+    root = root.parent if root.is_file() else root
+    return resolver.table(root)
+
+
+def _build_parser() -> argparse.ArgumentParser:
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "paths",
+        nargs="+",
+        metavar="path",
+        help="Files or directories to process, or `-` to read from stdin",
+    )
+    parser.add_argument(
+        "--stdin-filename",
+        help=(
+            "With `-`, the path of the file being read from stdin, used to find "
+            "its configuration and to check whether it's excluded"
+        ),
+    )
+    parser.add_argument(
+        "--files",
+        help="Regex pattern with which to match files to include",
+        required=False,
+        default=r"",
+    )
+    parser.add_argument(
+        "--exclude",
+        help="Regex pattern with which to match files to exclude",
+        required=False,
+        default=r"^$",
+    )
+    parser.add_argument(
+        "--unsafe",
+        action="store_true",
+        help="Also process if statements inside other blocks (like for loops)",
+    )
+    parser.add_argument(
+        "--comprehensions",
+        action="store_true",
+        help=(
+            "Also rewrite comprehensions whose element is repeated in their "
+            "filter, like `[f(x) for x in xs if f(x)]`"
+        ),
+    )
+    parser.add_argument(
+        "--while-loops",
+        action="store_true",
+        help=(
+            "Also rewrite `name = value` followed by `while name:` loops which "
+            "end with the same `name = value`"
+        ),
+    )
+    parser.add_argument(
+        "--until-stable",
+        action="store_true",
+        help=(
+            "Keep rewriting the functions which were rewritten until nothing "
+            "changes, rather than stopping after one pass"
+        ),
+    )
+    # black formatter's default
+    parser.add_argument("--line-length", type=int, default=88)
+    parser.add_argument(
+        "--cache-dir",
+        help=(
+            "Directory in which to remember files which don't need rewriting, "
+            "so they can be skipped on later runs"
+        ),
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Don't use a cache, even if --cache-dir is configured",
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="Don't write files back, just report which would be rewritten",
+    )
+    parser.add_argument(
+        "--diff",
+        action="store_true",
+        help="Don't write files back, print a diff of the changes instead",
+    )
+    parser.add_argument(
+        "--format",
+        choices=("text", "json"),
+        default="text",
+        help=(
+            "Output format. `json` prints a JSON object per changed file, with "
+            "the positions of the assignments and if-statements which were "
+            "combined"
+        ),
+    )
+    changed = parser.add_mutually_exclusive_group()
+    changed.add_argument(
+        "--changed-since",
+        metavar="REV",
+        help="Only process files which git reports as changed since REV",
+    )
+    changed.add_argument(
+        "--staged",
+        action="store_true",
+        help="Only process files with changes staged in git",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="Report how many files were checked, skipped and rewritten",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help=(
+            "Report time spent per phase, counts of files processed, skipped "
+            "and rewritten, and the slowest files"
+        ),
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="FILE",
+        help="Save a cProfile profile of the run to FILE (implies --jobs 1)",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of processes to use (default: number of CPUs)",
+    )
+    return parser
+
+
+def main(  # pragma: no cover
+    argv: Sequence[str] | None = None,
+    *,
+    stats: Stats | None = None,
+) -> int:
+    import argparse
+
+    parser = _build_parser()
+    # options which aren't passed on the command line are left unset, so
+    # that they can be taken from pyproject.toml instead of their defaults
+    unset = object()
+    args = parser.parse_args(
+        argv,
+        namespace=argparse.Namespace(
+            **{action.dest: unset for action in parser._actions if action.option_strings}
+        ),
+    )
+    stdin = "-" in args.paths
+    if stdin:
+        if len(args.paths) > 1:
+            parser.error("`-` can't be combined with other paths")
+        stdin_filename = None if args.stdin_filename is unset else args.stdin_filename
+        paths = [pathlib.Path(stdin_filename or "-").resolve()]
+    else:
+        paths = [pathlib.Path(path).resolve() for path in args.paths]
+
+    # `Config` options given on the command line take precedence over the
+    # pyproject.toml which applies to each file
+    config_fields = [field.name for field in dataclasses.fields(Config)]
+    resolver = ConfigResolver(
+        {name: parser.get_default(name) for name in config_fields},
+        {
+            name: getattr(args, name)
+            for name in config_fields
+            if getattr(args, name) is not unset
+        },
+    )
+    # other options may also be set in the pyproject.toml at the paths' root
+    table = {k.replace("-", "_"): v for k, v in _get_config(paths, resolver).items()}
+    for dest, value in vars(args).items():
+        if value is unset:
+            setattr(args, dest, table.get(dest, parser.get_default(dest)))
+    if stdin and (args.changed_since is not None or args.staged):
+        parser.error("`-` can't be combined with --changed-since or --staged")
+
+    if stats is None:
+        stats = Stats()
+    if stdin:
+        return _run_stdin(args, paths[0], resolver, stats)
+    if args.profile is not None:
+        # worker processes wouldn't be profiled
+        args.jobs = 1
+        import cProfile
+
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(_run, args, paths, parser, resolver, stats)
+        finally:
+            profiler.dump_stats(args.profile)
+    return _run(args, paths, parser, resolver, stats)
+
+
+def _discover(
+    args: argparse.Namespace,
+    paths: list[pathlib.Path],
+    parser: argparse.ArgumentParser,
+    files: re.Pattern[str],
+    exclude: re.Pattern[str],
+) -> list[pathlib.Path]:
+    import subprocess
+
+    filepaths: list[pathlib.Path] = []
+    if args.changed_since is not None or args.staged:
+        try:
+            changed_files = _git_changed_files(paths, args.changed_since)
+        except subprocess.CalledProcessError as exc:
+            parser.error(f"could not get changed files from git: {exc.stderr.strip()}")
+        except OSError as exc:
+            parser.error(f"could not run git: {exc}")
+        for p in changed_files:
+            if not p.is_file():
+                # e.g. staged, then deleted
+                continue
+            for path in paths:
+                if p == path or (
+                    path in p.parents and _is_included(p, path, files, exclude)
+                ):
+                    filepaths.append(p)
+                    break
+    else:
+        for path in paths:
+            if path.is_file():
+                filepaths.append(path)
+            else:
+                filepaths.extend(_iter_python_files(path, files, exclude))
+    return filepaths
+
+
+def _file_jobs(
+    filepaths: list[pathlib.Path],
+    resolver: ConfigResolver,
+    cache_dir: pathlib.Path | None,
+) -> tuple[list[FileJob], list[Cache]]:
+    """The files to process, grouped by configuration, and their caches."""
+    # usually, there's only one configuration
+    caches: dict[tuple[Any, ...], Cache] = {}
+    groups: dict[tuple[Any, ...], list[FileJob]] = {}
+    for filepath in filepaths:
+        config = resolver.config_for(filepath)
+        key = dataclasses.astuple(config)
+        if key not in groups:
+            if cache_dir is not None:
+                caches[key] = Cache(cache_dir, config)
+            groups[key] = []
+        groups[key].append((filepath, config, caches.get(key)))
+    file_jobs = [file_job for group in groups.values() for file_job in group]
+    return file_jobs, list(caches.values())
+
+
+def _report_file(
+    args: argparse.Namespace,
+    filepath: pathlib.Path,
+    result: FileResult,
+) -> None:
+    """Report that `filepath` was (or would be) rewritten."""
+    if args.format == "json":
+        sys.stdout.write(_json_report(filepath, result))
+    elif result.diff is not None:
+        sys.stdout.write(result.diff)
+    elif args.check:
+        sys.stdout.write(f"Would rewrite {filepath}\n")
+    else:
+        sys.stdout.write(f"Rewriting {filepath}\n")
+
+
+def _run(
+    args: argparse.Namespace,
+    paths: list[pathlib.Path],
+    parser: argparse.ArgumentParser,
+    resolver: ConfigResolver,
+    stats: Stats,
+) -> int:
+    ret = 0
+
+    files = re.compile(args.files, re.VERBOSE)
+    exclude = re.compile(args.exclude, re.VERBOSE)
+    with stats.timer("discover"):
+        filepaths = _discover(args, paths, parser, files, exclude)
+
+    cache_dir = (
+        pathlib.Path(args.cache_dir)
+        if args.cache_dir is not None and not args.no_cache
+        else None
+    )
+    with stats.timer("config"):
+        file_jobs, caches = _file_jobs(filepaths, resolver, cache_dir)
+    fix_file = functools.partial(
+        _fix_file_job,
+        write=not (args.check or args.diff),
+        diff=args.diff,
+    )
+    # files are written on threads, so that writing one file overlaps with
+    # analysing the next ones (unless there's only one file, for which it's
+    # not worth importing concurrent.futures and starting threads)
+    writer = None
+    writes = []
+    with contextlib.ExitStack() as stack:
+        if len(file_jobs) > 1:
+            import concurrent.futures
+
+            writer = stack.enter_context(
+                concurrent.futures.ThreadPoolExecutor(WRITE_THREADS)
+            )
+        for (filepath, _, _), result in zip(
+            file_jobs, _map(fix_file, file_jobs, args.jobs)
+        ):
+            stats.merge(result.stats)
+            if not result.changed:
+                continue
+            if result.new_data is None:
+                pass
+            elif writer is None:
+                with stats.timer("write"):
+                    _write_file(filepath, result.new_data)
+            else:
+                writes.append(writer.submit(_write_file, filepath, result.new_data))
+            _report_file(args, filepath, result)
+            ret = 1
+        with stats.timer("write"):
+            for write in writes:
+                write.result()
+    if caches:
+        with stats.timer("cache"):
+            # all configurations' entries are in the same directory
+            caches[0].prune()
+    if args.stats:
+        sys.stderr.write(stats.report())
+    elif args.verbose:
+        sys.stderr.write(
+            f"{stats.files_processed} file(s) checked, {stats.files_prefiltered} "
+            f"skipped without parsing, {stats.files_rewritten} rewritten\n"
+        )
+    return ret
+
+
+def _run_stdin(
+    args: argparse.Namespace,
+    path: pathlib.Path,
+    resolver: ConfigResolver,
+    stats: Stats,
+) -> int:
+    """Rewrite the source read from stdin, as if it were in `path`.
+
+    The rewritten source is written to stdout, unless reporting changes
+    (with --check, --diff or --format json) instead. Content which isn't
+    rewritten is written back as the exact bytes which were read.
+    """
+    data = sys.stdin.buffer.read()
+    display_name = pathlib.Path(args.stdin_filename or "-")
+    report = args.check or args.diff or args.format == "json"
+    result = FileResult()
+    result.stats.files_processed = 1
+    new_content = None
+    excluded = args.stdin_filename is not None and (
+        not re.search(args.files, path.as_posix(), re.VERBOSE)
+        or bool(re.search(args.exclude, path.as_posix(), re.VERBOSE))
+        or _is_excluded(path)
+    )
+    if not excluded:
+        config = resolver.config_for(path)
+        try:
+            content = data.decode("utf-8")
+        except UnicodeDecodeError:
+            content = ""
+        if not might_rewrite(content, config):
+            result.stats.files_prefiltered = 1
+        else:
+            with contextlib.suppress(*SOURCE_ERRORS):
+                new_content, result.rewrites = _auto_walrus(content, config, result.stats)
+    if new_content is not None:
+        result.changed = True
+        result.stats.files_rewritten = 1
+        if args.diff:
+            result.diff = _unified_diff(display_name, content, new_content)
+    stats.merge(result.stats)
+
+    if not report:
+        if new_content is None:
+            sys.stdout.buffer.write(data)
+        else:
+            sys.stdout.buffer.write(new_content.encode("utf-8"))
+        sys.stdout.flush()
+    elif result.changed:
+        if args.format == "json":
+            sys.stdout.write(_json_report(display_name, result))
+        elif result.diff is not None:
+            sys.stdout.write(result.diff)
+        else:
+            sys.stdout.write(f"Would rewrite {display_name}\n")
+    if args.stats:
+        sys.stderr.write(stats.report())
+    return int(report and result.changed)
+
+
+def _config_to_headers(config: Config) -> dict[str, str]:
+    headers = {}
+    for field in dataclasses.fields(config):
+        value = getattr(config, field.name)
+        headers[config_header(field.name)] = (
+            str(value).lower() if isinstance(value, bool) else str(value)
+        )
+    return headers
+
+
+def _config_from_headers(headers: Any) -> Config:
+    """Build a Config from request headers; raise ValueError if invalid."""
+    kwargs: dict[str, Any] = {}
+    for field in dataclasses.fields(Config):
+        header = config_header(field.name)
+        value = headers.get(header)
+        if value is None:
+            if field.default is dataclasses.MISSING:
+                msg = f"missing header {header}"
+                raise ValueError(msg)
+            continue
+        if field.type == "bool":
+            if value.lower() not in ("true", "false"):
+                msg = f"invalid value for {header}: {value!r}"
+                raise ValueError(msg)
+            kwargs[field.name] = value.lower() == "true"
+        else:
+            kwargs[field.name] = int(value)
+    return Config(**kwargs)
+
+
+@functools.lru_cache(maxsize=None)
+def _daemon_classes() -> tuple[
+    type[http.server.BaseHTTPRequestHandler],
+    Callable[..., http.server.ThreadingHTTPServer],
+]:
+    """Define `DaemonHandler` and `DaemonServer`.
+
+    They're only defined when first used, as `http.server` is slow to import
+    and most runs don't need it.
+    """
+    import http.server
+
+    class DaemonHandler(http.server.BaseHTTPRequestHandler):
+        """Rewrite the source POSTed to it.
+
+        The configuration is read from `X-Auto-Walrus-*` headers. Responds with
+        200 and the rewritten source, 204 if there's nothing to rewrite, or 400
+        (with the error message) if the request or the source is invalid.
+        """
+
+        server_version = f"auto-walrusd/{__version__}"
+
+        def do_POST(self) -> None:  # noqa: N802
+            try:
+                config = _config_from_headers(self.headers)
+                length = int(self.headers.get("Content-Length", 0))
+                content = self.rfile.read(length).decode("utf-8")
+            except ValueError as exc:  # includes UnicodeDecodeError
+                self._respond(400, str(exc))
+                return
+            assert isinstance(self.server, DaemonServer)
+            result = _rewrite_or_error(content, config, self.server.functions)
+            if isinstance(result, Exception):
+                self._respond(400, f"{type(result).__name__}: {result}")
+            elif result is None:
+                self._respond(204, "")
+            else:
+                self._respond(200, result)
+
+        def _respond(self, status: int, body: str) -> None:
+            data = body.encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "text/plain; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, fmt: str, *args: Any) -> None:
+            assert isinstance(self.server, DaemonServer)
+            if self.server.verbose:
+                super().log_message(fmt, *args)
+
+    class DaemonServer(http.server.ThreadingHTTPServer):
+        daemon_threads = True
+
+        def __init__(self, address: tuple[str, int], *, verbose: bool = False) -> None:
+            super().__init__(address, DaemonHandler)
+            self.verbose = verbose
+            # shared by all requests, so that unchanged functions of a file
+            # which is sent again aren't analysed again
+            self.functions = FunctionCache()
+
+    return DaemonHandler, DaemonServer
+
+
+def __getattr__(name: str) -> Any:
+    if name == "DaemonHandler":
+        return _daemon_classes()[0]
+    if name == "DaemonServer":
+        return _daemon_classes()[1]
+    msg = f"module {__name__!r} has no attribute {name!r}"
+    raise AttributeError(msg)
+
+
+def auto_walrus_daemon(
+    content: str,
+    config: Config,
+    *,
+    url: str = DAEMON_URL,
+    timeout: float = 5,
+) -> str | None:
+    """Like `auto_walrus`, but ask the daemon at `url` to do the work.
+
+    Falls back to running `auto_walrus` in-process if no daemon is running.
+    """
+    try:
+        return request_rewrite(
+            content, _config_to_headers(config), url=url, timeout=timeout
+        )
+    except DaemonError as exc:
+        if exc.status == 400:
+            # e.g. a syntax error, which `auto_walrus` treats as nothing to do
+            return None
+        raise
+    except OSError:  # e.g. connection refused, or timed out
+        return auto_walrus(content, config)
+
+
+def daemon_main(argv: Sequence[str] | None = None) -> int:  # pragma: no cover
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description=(
+            "Serve auto-walrus over HTTP, so that clients (such as editor "
+            "integrations) don't pay for starting a new process per file."
+        ),
+    )
+    parser.add_argument("--bind-host", default=DAEMON_HOST)
+    parser.add_argument("--bind-port", type=int, default=DAEMON_PORT)
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args(argv)
+    server = _daemon_classes()[1]((args.bind_host, args.bind_port), verbose=args.verbose)
+    sys.stderr.write(
+        f"auto-walrusd listening on http://{args.bind_host}:{server.server_port}/\n"
+    )
+    with server, contextlib.suppress(KeyboardInterrupt):
+        server.serve_forever()
+    return 0
 
 
 if __name__ == "__main__":
@@ -0,0 +1,138 @@
+"""Command-line client for the auto-walrus daemon, ``auto-walrusd``.
+
+Reads a source from stdin, and writes it (rewritten, if there's anything to
+rewrite) to stdout. This module only imports what it needs to talk to the
+daemon, and only imports `auto_walrus` itself if no daemon is running, so that
+editor integrations which run it on every save start up quickly.
+"""
+
+from __future__ import annotations
+
+import sys
+from typing import TYPE_CHECKING
+from typing import Mapping
+from typing import Sequence
+
+if TYPE_CHECKING:
+    import http.client
+
+DAEMON_HOST = "127.0.0.1"
+DAEMON_PORT = 45489
+DAEMON_URL = f"http://{DAEMON_HOST}:{DAEMON_PORT}/"
+# Config fields are sent as headers, e.g. `X-Auto-Walrus-Line-Length: 88`
+DAEMON_HEADER_PREFIX = "X-Auto-Walrus-"
+# the boolean `Config` fields, which are flags on the command line
+FLAGS = ("unsafe", "while_loops", "comprehensions", "until_stable")
+
+
+class DaemonError(Exception):
+    """The daemon responded with an error, e.g. for a source with a syntax error."""
+
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+def config_header(name: str) -> str:
+    """The header for the `Config` field `name`."""
+    return DAEMON_HEADER_PREFIX + name.replace("_", "-").title()
+
+
+def _connect(url: str, timeout: float) -> tuple[http.client.HTTPConnection, str]:
+    import http.client
+    import urllib.parse
+
+    parts = urllib.parse.urlsplit(url)
+    connection = http.client.HTTPConnection(
+        parts.hostname or DAEMON_HOST, parts.port or 80, timeout=timeout
+    )
+    return connection, parts.path or "/"
+
+
+def request_rewrite(
+    content: str,
+    headers: Mapping[str, str],
+    *,
+    url: str = DAEMON_URL,
+    timeout: float = 5,
+) -> str | None:
+    """Ask the daemon at `url` to rewrite `content`.
+
+    Returns the rewritten source, or None if there's nothing to rewrite.
+    Raises `DaemonError` if the daemon rejects the request, and `OSError` if
+    it can't be reached.
+    """
+    connection, path = _connect(url, timeout)
+    try:
+        connection.request("POST", path, body=content.encode("utf-8"), headers=headers)
+        response = connection.getresponse()
+        body = response.read().decode("utf-8")
+    finally:
+        connection.close()
+    if response.status == 204:
+        return None
+    if response.status != 200:
+        raise DaemonError(response.status, body)
+    return body
+
+
+def rewrite(
+    content: str,
+    headers: Mapping[str, str],
+    *,
+    url: str = DAEMON_URL,
+    timeout: float = 5,
+) -> str | None:
+    """Like `request_rewrite`, but run auto-walrus in-process if no daemon is running.
+
+    Raises `DaemonError` (with status 400) for an invalid source either way.
+    """
+    try:
+        return request_rewrite(content, headers, url=url, timeout=timeout)
+    except OSError:  # e.g. connection refused, or timed out
+        pass
+    import auto_walrus
+
+    result = auto_walrus._rewrite_or_error(
+        content, auto_walrus._config_from_headers(headers)
+    )
+    if isinstance(result, Exception):
+        raise DaemonError(400, f"{type(result).__name__}: {result}")
+    return result
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description=(
+            "Rewrite the source read from stdin with a running auto-walrusd, and "
+            "write it to stdout. Runs auto-walrus in-process if no daemon is "
+            "running."
+        ),
+    )
+    parser.add_argument("--url", default=DAEMON_URL)
+    parser.add_argument("--timeout", type=float, default=5)
+    parser.add_argument("--line-length", type=int, default=88)
+    for name in FLAGS:
+        parser.add_argument(f"--{name.replace('_', '-')}", action="store_true")
+    args = parser.parse_args(argv)
+    headers = {config_header("line_length"): str(args.line_length)}
+    for name in FLAGS:
+        headers[config_header(name)] = str(getattr(args, name)).lower()
+
+    data = sys.stdin.buffer.read()
+    try:
+        content = data.decode("utf-8")
+        result = rewrite(content, headers, url=args.url, timeout=args.timeout)
+    except (DaemonError, UnicodeDecodeError) as exc:
+        # e.g. a syntax error: leave the source as it is
+        sys.stderr.write(f"auto-walrus-client: {exc}\n")
+        sys.stdout.buffer.write(data)
+        return 1
+    sys.stdout.buffer.write(data if result is None else result.encode("utf-8"))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,295 @@
+"""Benchmarks for auto-walrus.
+
+Times `auto_walrus` and `main` (in default and `--unsafe` mode) on
+synthetic modules which scale function length, nesting depth, number of
+candidate assignments and number of files, as well as `auto_walrus` on a
+large module with a `FunctionCache` of all but one of its functions, and
+reports throughput and peak memory. Usage, from the repository root:
+
+    python benchmarks/run.py
+    python benchmarks/run.py --save baseline.json
+    python benchmarks/run.py --compare baseline.json
+    python benchmarks/run.py --corpus path/to/some/project
+
+It also times `import auto_walrus` in a new interpreter, and exits with
+status 1 if that takes longer than `IMPORT_TIME_BUDGET`. `--compare` exits
+with status 1 if any benchmark got slower (or used more memory) than the
+baseline by more than `--tolerance`. Timings depend on
+the machine, so no baseline is committed: save one from the main branch,
+and compare against it on the same machine, e.g.
+
+    git switch main && python benchmarks/run.py --save /tmp/baseline.json
+    git switch - && python benchmarks/run.py --compare /tmp/baseline.json
+
+`--corpus` also times `main` over a directory of real-world code (in
+`--check` mode, so nothing is written).
+"""
+
+from __future__ import annotations
+
+import argparse
+import contextlib
+import functools
+import io
+import json
+import pathlib
+import subprocess
+import sys
+import tempfile
+import textwrap
+import time
+import tracemalloc
+from typing import Callable
+from typing import Iterator
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from auto_walrus import Config
+from auto_walrus import FunctionCache
+from auto_walrus import auto_walrus
+from auto_walrus import main
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+CANDIDATE = "    {name} = compute({arg})\n    if {name}:\n        print({name})\n"
+NON_CANDIDATE = "    {name} = compute({arg})\n    print({name})\n"
+# seconds; importing takes about 35ms on a laptop (down from about 90ms when
+# everything was imported up front), this leaves room for slow machines
+IMPORT_TIME_BUDGET = 0.15
+
+
+def long_function(n_candidates: int, n_others: int) -> str:
+    """One function with `n_candidates` rewritable assignments."""
+    body = [CANDIDATE.format(name=f"v{i}", arg=f"x{i}") for i in range(n_candidates)]
+    body += [NON_CANDIDATE.format(name=f"w{i}", arg=f"x{i}") for i in range(n_others)]
+    return "def foo(" + ", ".join(f"x{i}" for i in range(10)) + "):\n" + "".join(body)
+
+
+def nested_functions(depth: int, n_candidates: int) -> str:
+    """Functions nested `depth` levels deep, each with some candidates."""
+    lines = []
+    for level in range(depth):
+        indent = "    " * level
+        lines.append(f"{indent}def f{level}():\n")
+        lines.extend(
+            textwrap.indent(CANDIDATE.format(name=f"v{level}_{i}", arg=f"x{i}"), indent)
+            for i in range(n_candidates)
+        )
+    return "".join(lines)
+
+
+def many_functions(n_functions: int, n_candidates: int) -> str:
+    """`n_functions` top-level functions."""
+    return "\n\n".join(
+        long_function(n_candidates, n_candidates).replace("def foo", f"def foo{i}")
+        for i in range(n_functions)
+    )
+
+
+def realistic_module(n_functions: int) -> str:
+    """Mostly code which can't be rewritten, with docstrings and comments.
+
+    Only one function in ten has a candidate, but that's enough for the
+    whole module to go through the rewriting step, where comments are
+    looked for, so this catches slowdowns there which the other
+    benchmarks' comment-free candidates don't.
+    """
+    functions = []
+    for i in range(n_functions):
+        body = [
+            f'    """Do step {i} (see #{i}).\n\n    Returns the result.\n    """\n',
+            "    # keep the order of {x} and {y}\n",
+            "    total = sum(x) + y  # type: int\n",
+            "    for item in x:\n        total += item\n",
+            f"    return helper(total, '#{i}')\n",
+        ]
+        if i % 10 == 0:
+            body.insert(2, CANDIDATE.format(name=f"v{i}", arg="y"))
+        functions.append(f"def step{i}(x, y):\n" + "".join(body))
+    return "\n\n".join(functions)
+
+
+def timed(func: Callable[[], object], repeat: int) -> float:
+    """Best wall-clock time of `repeat` calls."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def import_time(repeat: int) -> float:
+    """Best time of `repeat` imports of auto_walrus, each in a new interpreter."""
+    best = float("inf")
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import auto_walrus"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stderr
+        # lines look like `import time:  self [us] | cumulative | module`
+        for line in output.splitlines()[1:]:
+            _, cumulative, module = line.split("|")
+            if module.strip() == "auto_walrus":
+                best = min(best, int(cumulative) / 1e6)
+    return best
+
+
+def peak_memory(func: Callable[[], object]) -> int:
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def quiet_main(argv: list[str]) -> int:
+    with contextlib.redirect_stdout(io.StringIO()):
+        return main(argv)
+
+
+@contextlib.contextmanager
+def project(files: dict[str, str]) -> Iterator[pathlib.Path]:
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = pathlib.Path(tmpdir)
+        for name, content in files.items():
+            (root / name).write_text(content)
+        yield root
+
+
+def source_benchmarks() -> Iterator[tuple[str, str]]:
+    for n in (100, 1_000, 5_000):
+        yield f"long_function[{n}]", long_function(n, n)
+    for n in (0, 1_000):
+        yield f"candidates[{n}/5000]", long_function(n, 5_000 - n)
+    for depth in (5, 25, 50):
+        yield f"nested[{depth}]", nested_functions(depth, 20)
+    yield "many_functions[500]", many_functions(500, 5)
+
+
+def run(repeat: int, corpus: pathlib.Path | None) -> dict[str, dict[str, float]]:
+    seconds = import_time(repeat)
+    results: dict[str, dict[str, float]] = {"import": {"seconds": seconds}}
+    sys.stdout.write(f"{'import':<45} {seconds:>9.4f}s\n")
+
+    def record(name: str, func: Callable[[], object], n_lines: int) -> None:
+        seconds = timed(func, repeat)
+        results[name] = {
+            "seconds": seconds,
+            "lines_per_second": n_lines / seconds,
+            "peak_memory": peak_memory(func),
+        }
+        sys.stdout.write(
+            f"{name:<45} {seconds:>9.4f}s {n_lines / seconds:>12,.0f} lines/s "
+            f"{results[name]['peak_memory'] / 2**20:>8.1f} MiB\n"
+        )
+
+    for unsafe in (False, True):
+        mode = "unsafe" if unsafe else "default"
+        config = Config(line_length=88, unsafe=unsafe)
+        for name, src in source_benchmarks():
+            n_lines = src.count("\n")
+            record(
+                f"auto_walrus:{name}:{mode}",
+                functools.partial(auto_walrus, src, config),
+                n_lines,
+            )
+
+        # a large file in which one function changed since the last run
+        src = many_functions(500, 5)
+        cache = FunctionCache()
+        auto_walrus(src, config, cache=cache)
+        edited = src.replace("def foo0(", "def foo0(y, ", 1)
+        record(
+            f"auto_walrus:many_functions[500]:one_edited:{mode}",
+            functools.partial(auto_walrus, edited, config, cache=cache),
+            edited.count("\n"),
+        )
+
+        flags = ["--check", *(["--unsafe"] if unsafe else [])]
+        for n_files in (10, 500):
+            src = long_function(50, 50)
+            files = {f"module_{i}.py": src for i in range(n_files)}
+            with project(files) as root:
+                for jobs in ("1", "4"):
+                    record(
+                        f"main:files[{n_files}]:jobs[{jobs}]:{mode}",
+                        functools.partial(
+                            quiet_main, [*flags, "--jobs", jobs, str(root)]
+                        ),
+                        src.count("\n") * n_files,
+                    )
+
+        src = realistic_module(200)
+        files = {f"module_{i}.py": src for i in range(50)}
+        with project(files) as root:
+            record(
+                f"main:realistic[50]:jobs[1]:{mode}",
+                functools.partial(quiet_main, [*flags, "--jobs", "1", str(root)]),
+                src.count("\n") * len(files),
+            )
+
+        if corpus is not None:
+            n_lines = 0
+            for path in corpus.rglob("*.py"):
+                with contextlib.suppress(OSError, UnicodeDecodeError):
+                    n_lines += path.read_text(encoding="utf-8").count("\n")
+            record(
+                f"main:corpus:{mode}",
+                functools.partial(quiet_main, [*flags, str(corpus)]),
+                n_lines,
+            )
+    return results
+
+
+def compare(
+    results: dict[str, dict[str, float]],
+    baseline: dict[str, dict[str, float]],
+    tolerance: float,
+) -> int:
+    ret = 0
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for metric in ("seconds", "peak_memory"):
+            if metric not in result:
+                continue
+            ratio = result[metric] / baseline[name][metric]
+            if ratio > tolerance:
+                sys.stdout.write(f"REGRESSION {name} {metric}: {ratio:.2f}x baseline\n")
+                ret = 1
+    if not ret:
+        sys.stdout.write("No regressions compared to baseline\n")
+    return ret
+
+
+def cli() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per benchmark")
+    parser.add_argument("--corpus", type=pathlib.Path, help="Directory of real code")
+    parser.add_argument("--save", type=pathlib.Path, help="Write results as JSON")
+    parser.add_argument("--compare", type=pathlib.Path, help="Baseline JSON file")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=1.2,
+        help="Maximum allowed ratio to the baseline (default: 1.2)",
+    )
+    args = parser.parse_args()
+    results = run(args.repeat, args.corpus)
+    if args.save is not None:
+        args.save.write_text(json.dumps(results, indent=2) + "\n")
+    ret = 0
+    if results["import"]["seconds"] > IMPORT_TIME_BUDGET:
+        sys.stdout.write(f"OVER BUDGET import: more than {IMPORT_TIME_BUDGET}s\n")
+        ret = 1
+    if args.compare is not None:
+        ret |= compare(results, json.loads(args.compare.read_text()), args.tolerance)
+    return ret
+
+
+if __name__ == "__main__":
+    sys.exit(cli())
@@ -1,15 +1,47 @@
 from __future__ import annotations
 
+import array
+import ast
+import contextlib
+import dataclasses
+import http.server
+import io
+import json
+import os
 import pathlib
+import shutil
+import socket
+import stat
+import subprocess
+import sys
+import threading
+import urllib.error
+import urllib.request
 from typing import Any
+from typing import Iterator
 from typing import List
 from typing import Tuple
 
 import pytest
 
+import auto_walrus as auto_walrus_module
+import auto_walrus_client
+from auto_walrus import Cache
 from auto_walrus import Config
+from auto_walrus import ConfigResolver
+from auto_walrus import DaemonServer
+from auto_walrus import Edit
+from auto_walrus import FunctionCache
+from auto_walrus import GitIgnore
+from auto_walrus import ScopeCollector
+from auto_walrus import Stats
+from auto_walrus import apply_edits
 from auto_walrus import auto_walrus
+from auto_walrus import auto_walrus_daemon
+from auto_walrus import auto_walrus_edits
+from auto_walrus import auto_walrus_many
 from auto_walrus import main
+from auto_walrus import might_rewrite
 
 
 @pytest.mark.parametrize(
@@ -87,13 +119,515 @@ from auto_walrus import main
             "    elif (a := 0):\n"
             "        print(a)\n",
         ),
+        (
+            "async def foo():\n    a = await bar()\n    if a:\n        print(a)\n",
+            "async def foo():\n    if (a := await bar()):\n        print(a)\n",
+        ),
+        (
+            "class Foo:\n"
+            "    async def foo(self):\n"
+            "        a = 0\n"
+            "        if a:\n"
+            "            print(a)\n",
+            "class Foo:\n"
+            "    async def foo(self):\n"
+            "        if (a := 0):\n"
+            "            print(a)\n",
+        ),
+        (
+            "def foo():\n"
+            "    async def bar():\n"
+            "        a = 0\n"
+            "        if a:\n"
+            "            print(a)\n",
+            "def foo():\n"
+            "    async def bar():\n"
+            "        if (a := 0):\n"
+            "            print(a)\n",
+        ),
+        (
+            "def foo():\n"
+            "    a = 0; b = 1\n"
+            "    if a:\n"
+            "        print(a)\n"
+            "    if b:\n"
+            "        print(b)\n",
+            "def foo():\n"
+            "    if (a := 0):\n"
+            "        print(a)\n"
+            "    if (b := 1):\n"
+            "        print(b)\n",
+        ),
+        (
+            "def foo():\n    a = 0;\n    if a:\n        print(a)\n",
+            "def foo():\n    if (a := 0):\n        print(a)\n",
+        ),
     ],
 )
 def test_rewrite(src: str, expected: str) -> None:
+    assert might_rewrite(src)
     ret = auto_walrus(src, Config(line_length=88))
     assert ret == expected
 
 
+@pytest.mark.parametrize(
+    ("src", "expected"),
+    [
+        # not a comment
+        (
+            'def foo():\n    a = "#"\n    if a:\n        print(a)\n',
+            'def foo():\n    if (a := "#"):\n        print(a)\n',
+        ),
+        (
+            "def foo():\n    a = 0\n    if a:  # note\n        print(a)\n",
+            "def foo():\n    if (a := 0):  # note\n        print(a)\n",
+        ),
+        # the comment is moved to the if statement
+        (
+            "def foo():\n    a = 0  # note\n    if a:\n        print(a)\n",
+            "def foo():\n    if (a := 0):  # note\n        print(a)\n",
+        ),
+        (
+            "def foo():\n    b = 0; a = 0  # note\n    if a:\n        print(a)\n",
+            "def foo():\n    b = 0;   # note\n    if (a := 0):\n        print(a)\n",
+        ),
+        (
+            "def foo():\n"
+            "    a = 0  # note a\n"
+            "    b = 1  # note b\n"
+            "    if a > b:\n"
+            "        print(a, b)\n",
+            "def foo():\n"
+            "    a = 0  # note a\n"
+            "    if a > (b := 1):  # note b\n"
+            "        print(a, b)\n",
+        ),
+    ],
+)
+def test_rewrite_comments(src: str, expected: str) -> None:
+    ret = auto_walrus(src, Config(line_length=88))
+    assert ret == expected
+
+
+@pytest.mark.parametrize(
+    "src",
+    [
+        # the if statement's line continues, so a comment can't be appended to it
+        "def foo():\n    a = 0  # note\n    if a == \\\n            1:\n        print(a)\n",
+        'def foo():\n    a = 0  # note\n    if a == """\n""":\n        print(a)\n',
+        # these comments only apply to the line they're on
+        "def foo():\n    a = f()  # noqa: F841\n    if a:\n        print(a)\n",
+        "def foo():\n    a = []  # type: list[int]\n    if a:\n        print(a)\n",
+        "def foo():\n    a = 0  # pragma: no cover\n    if a:\n        print(a)\n",
+    ],
+)
+def test_rewrite_comments_not_moved(src: str) -> None:
+    assert auto_walrus(src, Config(line_length=88)) is None
+
+
+WHILE_SRC = (
+    "def foo(f):\n"
+    "    chunk = f.read(10)\n"
+    "    while chunk:\n"
+    "        print(chunk)\n"
+    "        chunk = f.read(10)\n"
+)
+
+
+@pytest.mark.parametrize(
+    ("src", "expected"),
+    [
+        (
+            WHILE_SRC,
+            "def foo(f):\n    while (chunk := f.read(10)):\n        print(chunk)\n",
+        ),
+        (
+            WHILE_SRC.replace("while chunk:", "while chunk != b'':"),
+            "def foo(f):\n"
+            "    while (chunk := f.read(10)) != b'':\n"
+            "        print(chunk)\n",
+        ),
+        (
+            WHILE_SRC.replace("print(chunk)", "for x in chunk:\n            continue"),
+            "def foo(f):\n"
+            "    while (chunk := f.read(10)):\n"
+            "        for x in chunk:\n"
+            "            continue\n",
+        ),
+        (
+            # a `continue` in a nested function is for some other loop
+            WHILE_SRC.replace("print(chunk)", "def g():\n            continue"),
+            "def foo(f):\n"
+            "    while (chunk := f.read(10)):\n"
+            "        def g():\n"
+            "            continue\n",
+        ),
+        # the tail's separator is removed too
+        (
+            WHILE_SRC.replace("f.read(10)\n", "f.read(10);\n"),
+            "def foo(f):\n    while (chunk := f.read(10)):\n        print(chunk)\n",
+        ),
+        # the last line is left empty
+        (
+            WHILE_SRC.rstrip("\n"),
+            "def foo(f):\n    while (chunk := f.read(10)):\n        print(chunk)\n",
+        ),
+        (
+            WHILE_SRC.replace("print(chunk)\n        chunk", "print(chunk); chunk"),
+            "def foo(f):\n    while (chunk := f.read(10)):\n        print(chunk); \n",
+        ),
+    ],
+)
+def test_rewrite_while_loops(src: str, expected: str) -> None:
+    assert might_rewrite(src, Config(line_length=88, while_loops=True))
+    ret = auto_walrus(src, Config(line_length=88, while_loops=True))
+    assert ret == expected
+    assert auto_walrus(src, Config(line_length=88)) is None
+
+
+@pytest.mark.parametrize(
+    "src",
+    [
+        # different values
+        WHILE_SRC.replace("        chunk = f.read(10)", "        chunk = f.read(20)"),
+        # `continue` would skip the tail assignment
+        WHILE_SRC.replace("print(chunk)", "if chunk == 'x':\n            continue"),
+        # the tail assignment isn't last
+        WHILE_SRC + "        print(chunk)\n",
+        # the loop would be empty
+        WHILE_SRC.replace("        print(chunk)\n", ""),
+        WHILE_SRC + "    else:\n        print(0)\n",
+        WHILE_SRC + "    return chunk\n",
+        WHILE_SRC.replace("while chunk:", "while chunk and chunk[0]:"),
+        WHILE_SRC.replace("    while chunk:", "    f = None\n    while chunk:"),
+        WHILE_SRC.replace(
+            "        chunk = f.read(10)", "        chunk = f.read(10)  # c"
+        ),
+        # no assignment before the loop
+        WHILE_SRC.replace("    chunk = f.read(10)\n    while", "    while"),
+        # the tail assigns to another name than the one which is assigned first
+        "def foo(g, a):\n    b = g()\n    while a == b:\n        print(b)\n        a = g()\n",
+    ],
+)
+def test_noop_while_loops(src: str) -> None:
+    assert auto_walrus(src, Config(line_length=88, while_loops=True)) is None
+
+
+def test_rewrite_while_loops_unsafe() -> None:
+    src = "def foo(f):\n    for _ in range(3):\n" + "".join(
+        f"    {line}\n" for line in WHILE_SRC.splitlines()[1:]
+    )
+    expected = (
+        "def foo(f):\n"
+        "    for _ in range(3):\n"
+        "        while (chunk := f.read(10)):\n"
+        "            print(chunk)\n"
+    )
+    assert auto_walrus(src, Config(line_length=88, while_loops=True)) is None
+    assert (
+        auto_walrus(src, Config(line_length=88, unsafe=True, while_loops=True))
+        == expected
+    )
+
+
+def test_main_while_loops(tmp_path: pathlib.Path) -> None:
+    path = tmp_path / "a.py"
+    path.write_text("x = 1\n" + WHILE_SRC)
+    main([str(path)])
+    assert path.read_text() == "x = 1\n" + WHILE_SRC
+    main(["--while-loops", str(path)])
+    assert "while (chunk := f.read(10)):" in path.read_text()
+
+
+@pytest.mark.parametrize(
+    ("src", "expected"),
+    [
+        (
+            "def foo(xs):\n    return [f(x) for x in xs if f(x)]\n",
+            "def foo(xs):\n    return [_value for x in xs if (_value := f(x))]\n",
+        ),
+        (
+            "def foo(xs):\n    return {f(x) for x in xs if f(x) > 0}\n",
+            "def foo(xs):\n    return {_value for x in xs if (_value := f(x)) > 0}\n",
+        ),
+        (
+            "def foo(xs):\n    return sum(f(x) for x in xs if x if f(x))\n",
+            "def foo(xs):\n    return sum(_value for x in xs if x if (_value := f(x)))\n",
+        ),
+        (
+            "def foo(d):\n"
+            "    return {k: g(v) for k, v in d.items() if g(v) is not None}\n",
+            "def foo(d):\n"
+            "    return {k: _value for k, v in d.items() if (_value := g(v)) is not None}\n",
+        ),
+        (
+            "def foo(xs):\n    return {g(x): x for x in xs if g(x)}\n",
+            "def foo(xs):\n    return {_value: x for x in xs if (_value := g(x))}\n",
+        ),
+        (
+            "def foo(xs, _value):\n"
+            "    a = [f(x) for x in xs if f(x)]\n"
+            "    b = [\n"
+            "        g(x)\n"
+            "        for x in xs\n"
+            "        if g(x)\n"
+            "    ]\n"
+            "    def bar():\n"
+            "        return [f(x) for x in xs if f(x)]\n",
+            "def foo(xs, _value):\n"
+            "    a = [_value1 for x in xs if (_value1 := f(x))]\n"
+            "    b = [\n"
+            "        _value2\n"
+            "        for x in xs\n"
+            "        if (_value2 := g(x))\n"
+            "    ]\n"
+            "    def bar():\n"
+            "        return [_value1 for x in xs if (_value1 := f(x))]\n",
+        ),
+    ],
+)
+def test_rewrite_comprehensions(src: str, expected: str) -> None:
+    assert might_rewrite(src, Config(line_length=88, comprehensions=True))
+    ret = auto_walrus(src, Config(line_length=88, comprehensions=True))
+    assert ret == expected
+
+
+@pytest.mark.parametrize(
+    "src",
+    [
+        # not in a function
+        "xs = [f(x) for x in xs if f(x)]\n",
+        "def foo():\n    class Foo:\n        xs = [f(x) for x in xs if f(x)]\n",
+        "class Foo:\n    @bar([f(x) for x in xs if f(x)])\n    def foo(self): ...\n",
+        "def foo():\n    return lambda: [f(x) for x in xs if f(x)]\n",
+        "def foo():\n    return [[f(x) for x in xs if f(x)] for xs in xss]\n",
+        # not a call
+        "def foo():\n    return [x.y for x in xs if x.y]\n",
+        # evaluated differently
+        "def foo():\n    return [f(x) for x in xs if f(x) if x]\n",
+        "def foo():\n    return [f(x) for x in xs if f(x) > g(x)]\n",
+        "def foo():\n    return [f(x) for x in xs if f(y)]\n",
+        "def foo():\n    return {g(x): f(x) for x in xs if f(x)}\n",
+        "def foo():\n    return [f(x) for x in xs if f(x) or x]\n",
+        "def foo():\n    return [f(x, (y := 1)) for x in xs if f(x, (y := 1))]\n",
+        "def foo():\n    return [f(x) for x in xs if f(x)]  # no-walrus\n",
+        "def foo():\n    return [f(x) for x in xs if f(\n        x\n    )]\n",
+        "def foo():\n    return [f(x) for x in xs if f(x)] + [thequickbrownfox]\n",
+    ],
+)
+def test_noop_comprehensions(src: str) -> None:
+    assert auto_walrus(src, Config(line_length=50, comprehensions=True)) is None
+
+
+@pytest.mark.parametrize("newline", ["\r\n", "\r"])
+def test_rewrite_preserves_newlines(newline: str) -> None:
+    src = (
+        "def foo():\n    a = 0\n    if a:\n        print(a)\n\n"
+        "def bar():\n    b = 1\n    if b:\n        print(b)\n"
+    )
+    ret = auto_walrus(src.replace("\n", newline), Config(line_length=88))
+    assert ret == (
+        "def foo():\n    if (a := 0):\n        print(a)\n\n"
+        "def bar():\n    if (b := 1):\n        print(b)\n"
+    ).replace("\n", newline)
+
+
+def test_rewrite_no_trailing_newline() -> None:
+    # the edited line is the last one, and doesn't end with a newline
+    src = "def foo():\n    a = 0\n    if a: print(a)"
+    ret = auto_walrus(src, Config(line_length=88))
+    assert ret == "def foo():\n    if (a := 0): print(a)"
+
+
+def test_rewrite_non_ascii() -> None:
+    # `ast` gives column offsets in bytes
+    src = 'def foo():\n    a = "é"; b = 0\n    if b:\n        print(a, b)\n'
+    ret = auto_walrus(src, Config(line_length=88))
+    assert ret == 'def foo():\n    a = "é"; \n    if (b := 0):\n        print(a, b)\n'
+
+
+@pytest.mark.parametrize("comprehensions", [False, True])
+def test_rewrite_deeply_nested(*, comprehensions: bool) -> None:
+    # deeper than the recursion limit, though not too deep to parse
+    src = f"def foo():\n    b = {' + '.join(['x'] * 1000)}\n{SRC_ORIG[11:]}"
+    ret = auto_walrus(src, Config(line_length=88, comprehensions=comprehensions))
+    assert ret == src.replace("    a = 0\n    if a:", "    if (a := 0):")
+
+
+def test_rewrite_invalid() -> None:
+    assert (
+        auto_walrus(
+            "def foo():\n    a = 0\n    if a\n        print(a)\n", Config(line_length=88)
+        )
+        is None
+    )
+
+
+def test_rewrite_form_feed() -> None:
+    # form feeds aren't line breaks for Python, though `str.splitlines` splits on them
+    src = "\x0cdef foo():\n    a = 0\n    if a:\n        print(a)\n"
+    ret = auto_walrus(src, Config(line_length=88))
+    assert ret == "\x0cdef foo():\n    if (a := 0):\n        print(a)\n"
+
+
+def test_scope_collector() -> None:
+    collector = ScopeCollector()
+    collector.visit(
+        ast.parse(
+            "a = 0\nif a:\n    pass\ndef foo():\n    b = 0\n    if b:\n        pass\n"
+        )
+    )
+    # what's outside functions isn't collected
+    (analysis,) = collector.analyses
+    assert [assignment[0][0] for assignment in analysis.assignments] == ["b"]
+    assert [if_test[0][0] for if_test in analysis.ifs] == ["b"]
+    assert collector.interned == {"b": 0}
+
+
+def test_name_index_shared_start() -> None:
+    # as for `a` and `c` in `f"{a:{b}}{c:{d}}"` on Python 3.8
+    start = auto_walrus_module.position_key(4, 15)
+    index = auto_walrus_module.NameIndex(
+        array.array("i", [0, 1]),
+        array.array("q", [start, start]),
+        {"a": 0, "c": 1},
+        {0: array.array("i", [0]), 1: array.array("i", [1])},
+    )
+    assert index.index_of(("a", 4, 15, 4, 16)) == 0
+    assert index.index_of(("c", 4, 15, 4, 16)) == 1
+
+
+def test_rewrite_until_stable(monkeypatch: pytest.MonkeyPatch) -> None:
+    src = (
+        "def foo():\n    a = 0\n    if a:\n        print(a)\n"
+        "def bar():\n    print(1)\n"
+        "class A:\n"
+        "    @deco\n"
+        "    def baz(self):\n"
+        "        b = 0\n"
+        "        if b:\n"
+        "            print(b)"
+    )
+    expected = auto_walrus(src, Config(line_length=88))
+    parsed: list[str] = []
+    parse = ast.parse
+
+    def recording_parse(source: str) -> ast.Module:
+        parsed.append(source)
+        return parse(source)
+
+    monkeypatch.setattr("ast.parse", recording_parse)
+    assert auto_walrus(src, Config(line_length=88, until_stable=True)) == expected
+    # the rewritten functions are parsed again, on their own, and don't change
+    assert parsed == [
+        src,
+        "def foo():\n    if (a := 0):\n        print(a)\n",
+        "if True:\n"
+        "    @deco\n"
+        "    def baz(self):\n"
+        "        if (b := 0):\n"
+        "            print(b)",
+    ]
+
+
+def test_function_cache(monkeypatch: pytest.MonkeyPatch, tmp_path: pathlib.Path) -> None:
+    src = (
+        "def foo():\n    a = 0\n    if a:\n        print(a)\n"
+        "class A:\n"
+        "    def bar(self):\n        b = 0\n        if b:\n            print(b)\n"
+        "def baz(xs):\n    return [f(x) for x in xs if f(x)]\n"
+    )
+    config = Config(line_length=88, comprehensions=True)
+    analysed: list[str] = []
+    analyse_function = auto_walrus_module._analyse_function
+
+    def recording_analyse_function(
+        node: ast.FunctionDef | ast.AsyncFunctionDef, config: Config
+    ) -> auto_walrus_module.FunctionResult:
+        analysed.append(node.name)
+        return analyse_function(node, config)
+
+    monkeypatch.setattr("auto_walrus._analyse_function", recording_analyse_function)
+    cache = FunctionCache()
+    expected = auto_walrus(src, config)
+    assert auto_walrus(src, config, cache=cache) == expected
+    assert analysed == ["foo", "baz", "bar", "foo", "baz", "bar"]
+    # functions which were seen before aren't analysed again, even if they moved
+    analysed.clear()
+    edited = "import os\n" + src.replace("print(a)", "print(a, os)")
+    assert auto_walrus(edited, config, cache=cache) == auto_walrus(edited, config)
+    assert analysed == ["foo", "foo", "baz", "bar"]
+    analysed.clear()
+    assert auto_walrus(src, Config(line_length=89), cache=cache) is not None
+    assert analysed == ["foo", "baz", "bar"]
+
+    # results can be saved for a file, for later runs
+    store = Cache(tmp_path, config)
+    path = tmp_path / "a.py"
+    assert store.read_functions(path) == {}
+    cache = FunctionCache()
+    assert auto_walrus(src, config, cache=cache) == expected
+    assert cache.changed
+    store.write_functions(path, cache.results())
+    analysed.clear()
+    cache = FunctionCache(max_entries=1, previous=store.read_functions(path))
+    assert auto_walrus(edited, config, cache=cache) == auto_walrus(edited, config)
+    assert analysed == ["foo", "foo", "baz", "bar"]
+    # only the most recently used function is kept in memory
+    bar = src[src.index("    def bar") : src.index("def baz")]
+    assert list(cache.results()) == [FunctionCache.key(bar, config)]
+    # nothing new was analysed for an unchanged source
+    cache = FunctionCache(previous=store.read_functions(path))
+    assert auto_walrus(src, config, cache=cache) == expected
+    assert not cache.changed
+    # a damaged entry is ignored
+    next(store.functions_directory.iterdir()).write_text("{")
+    assert store.read_functions(path) == {}
+
+
+@pytest.mark.parametrize(
+    ("src", "expected"),
+    [
+        (
+            "def foo():\r\n    a = 0  # note\r\n    if a:\r\n        print(a)\r\n",
+            [
+                Edit(2, 0, 3, 0, ""),
+                Edit(3, 7, 3, 8, "(a := 0)"),
+                Edit(3, 9, 3, 9, "  # note"),
+            ],
+        ),
+        (
+            'def foo():\n    a = "é"; b = 0\n    if b:\n        print(a, b)\n',
+            [Edit(2, 13, 2, 18, ""), Edit(3, 7, 3, 8, "(b := 0)")],
+        ),
+        ("def foo():\n    a = 0\n    print(a)\n", []),
+    ],
+)
+def test_auto_walrus_edits(src: str, expected: list[Edit]) -> None:
+    tree = ast.parse(src)
+    edits = auto_walrus_edits(tree, src.splitlines(keepends=True), Config(88))
+    assert edits == expected
+    assert apply_edits(src, edits) == (auto_walrus(src, Config(88)) or src)
+
+
+def test_apply_edits() -> None:
+    # e.g. combined with another fixer's edits
+    src = "def foo():\n    a = 0\n    if a:\n        print(a)"
+    edits = auto_walrus_edits(ast.parse(src), src.splitlines(keepends=True), Config(88))
+    assert apply_edits(src, [*edits, Edit(4, 8, 4, 13, "log")]) == (
+        "def foo():\n    if (a := 0):\n        log(a)"
+    )
+    with pytest.raises(ValueError, match="overlapping"):
+        apply_edits(src, [*edits, Edit(3, 4, 3, 8, "")])
+
+
+def test_main_preserves_newlines(tmp_path: pathlib.Path) -> None:
+    path = tmp_path / "a.py"
+    path.write_bytes(SRC_ORIG.replace("\n", "\r\n").encode())
+    main([str(path)])
+    assert path.read_bytes() == SRC_CHANGED.replace("\n", "\r\n").encode()
+
+
 @pytest.mark.parametrize(
     "src",
     [
@@ -112,6 +646,8 @@ def test_rewrite(src: str, expected: str) -> None:
         "        print(a)\n",
         "def foo():\n    a = 0  # no-walrus\n    if a:\n        print(a)\n",
         "def foo():\n    a = 0\n    if a:  # no-walrus\n        print(a)\n",
+        "def foo():\n    a = 0  # note\n    if a:  # note\n        print(a)\n",
+        "def foo():\n    a = 0  # a rather long comment here\n    if a:\n        print(a)\n",
         "n = 10\nif foo(a := n+1):\n    print(n)\n",
         "a = 0\nif False and a:\n    print(a)\nelse:\n    print(a)\n",
         "def foo():\n    a = 1\n    if a:\n        print(a)\n    a = 2\n",
@@ -123,6 +659,11 @@ def test_rewrite(src: str, expected: str) -> None:
         "        print(n)\n",
         "def foo():\n    n = 10\n    if n > np.sin(foo.bar.quox):\n        print(n)\n",
         "def foo():\n    n = 10\n    if True or n > 3:\n        print(n)\n",
+        "async def foo(xs):\n"
+        "    async for x in xs:\n"
+        "        a = await x\n"
+        "        if a:\n"
+        "            print(a)\n",
     ],
 )
 def test_noop(src: str) -> None:
@@ -130,6 +671,33 @@ def test_noop(src: str) -> None:
     assert ret is None
 
 
+@pytest.mark.parametrize(
+    "src",
+    [
+        "a = 0\nif a:\n    print(a)\n",
+        "def foo():\n    a = 0\n    print(a)\n",
+        "def foo():\n    if a:\n        print(a)\n",
+        "def foo():\n    a == 0\n    if a:\n        print(a)\n",
+        "def foo():\n    a = 0\n    if b:\n        print(a)\n",
+        "def foo():\n    x.a = 0\n    if a:\n        print(a)\n",
+    ],
+)
+def test_prefiltered(src: str) -> None:
+    assert not might_rewrite(src)
+
+
+@pytest.mark.parametrize(
+    "src",
+    [
+        "def foo():\n    (a) = 0\n    if a:\n        print(a)\n",
+        # non-ascii identifiers are normalised by the parser
+        "def foo():\n    \uff41 = 0\n    if a:\n        print(a)\n",
+    ],
+)
+def test_not_prefiltered(src: str) -> None:
+    assert might_rewrite(src)
+
+
 @pytest.mark.parametrize(
     ("src", "expected"),
     [
@@ -151,9 +719,28 @@ def test_noop(src: str) -> None:
             "            if (conn_time_zone := fetch_rel_time_zone(df.native)) != time_zone:\n"
             "                print(conn_time_zone)\n",
         ),
+        (
+            "async def foo(xs, lock):\n"
+            "    async for x in xs:\n"
+            "        a = await x\n"
+            "        if a:\n"
+            "            print(a)\n"
+            "    async with lock:\n"
+            "        b = await lock.value()\n"
+            "        if b > 0:\n"
+            "            print(b)\n",
+            "async def foo(xs, lock):\n"
+            "    async for x in xs:\n"
+            "        if (a := await x):\n"
+            "            print(a)\n"
+            "    async with lock:\n"
+            "        if (b := await lock.value()) > 0:\n"
+            "            print(b)\n",
+        ),
     ],
 )
 def test_rewrite_unsafe(src: str, expected: str) -> None:
+    assert might_rewrite(src)
     ret = auto_walrus(src, Config(line_length=88, unsafe=True))
     assert ret == expected
 
@@ -226,6 +813,55 @@ def test_config_file_no_auto_walrus(project_dir: ProjectDirT) -> None:
         assert file.read_text() == SRC_CHANGED, f"Unexpected result for {file}"
 
 
+@pytest.mark.config_content("[tool.auto-walrus]\nline-length = 10\n")
+@pytest.mark.parametrize(
+    ("argv", "expected"),
+    [
+        ([], [SRC_CHANGED, SRC_CHANGED, SRC_ORIG]),
+        (["--line-length", "10"], [SRC_ORIG, SRC_ORIG, SRC_ORIG]),
+        (["--line-length", "88"], [SRC_CHANGED, SRC_CHANGED, SRC_CHANGED]),
+    ],
+)
+def test_config_file_per_directory(
+    project_dir: ProjectDirT,
+    argv: list[str],
+    expected: list[str],
+) -> None:
+    project_root, files = project_dir
+    # submodule1 and submodule2 are subprojects with their own configuration.
+    # Tables aren't merged, so a.py gets the default line length.
+    (project_root / "submodule1" / "pyproject.toml").write_text(
+        "[tool.auto-walrus]\nline-length = 88\n"
+    )
+    (project_root / "submodule1" / "submodule2" / "pyproject.toml").write_text(
+        "[tool.auto-walrus]\nunsafe = true\n"
+    )
+    main([*argv, str(project_root)])
+    assert [file.read_text() for file in files] == expected
+
+
+def test_config_resolver_memoised(
+    tmp_path: pathlib.Path,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    (tmp_path / "pyproject.toml").write_text("[tool.auto-walrus]\nunsafe = true\n")
+    (tmp_path / "a" / "b").mkdir(parents=True)
+    (tmp_path / "c").mkdir()
+    (tmp_path / "c" / "pyproject.toml").write_text("[tool.other]\n")
+    parsed: list[pathlib.Path] = []
+    read_pyproject = auto_walrus_module._read_pyproject
+
+    def recording_read_pyproject(path: pathlib.Path) -> dict[str, Any]:
+        parsed.append(path)
+        return read_pyproject(path)
+
+    monkeypatch.setattr("auto_walrus._read_pyproject", recording_read_pyproject)
+    resolver = ConfigResolver(overrides={"line_length": 10})
+    for path in ("x.py", "a/x.py", "a/b/x.py", "a/b/y.py", "c/x.py"):
+        assert resolver.config_for(tmp_path / path) == Config(line_length=10, unsafe=True)
+    assert len(parsed) == 2
+
+
 def test_config_file_missing(project_dir: ProjectDirT) -> None:
     project_root, files = project_dir
     main([str(project_root)])
@@ -246,3 +882,816 @@ def test_complains_when_no_paths(capsys: pytest.CaptureFixture[str]) -> None:
         main([])
     assert ei.value.code == 2
     assert "the following arguments are required" in capsys.readouterr().err
+
+
+@pytest.mark.parametrize("jobs", ["1", "2"])
+def test_jobs(
+    project_dir: ProjectDirT,
+    capsys: pytest.CaptureFixture[str],
+    monkeypatch: pytest.MonkeyPatch,
+    jobs: str,
+) -> None:
+    monkeypatch.setattr("auto_walrus.MIN_FILES_FOR_PROCESSES", 0)
+    project_root, files = project_dir
+    ret = main(["--jobs", jobs, str(files[2]), str(files[0]), str(files[1])])
+    assert ret == 1
+    for file in files:
+        assert file.read_text() == SRC_CHANGED, f"Unexpected result for {file}"
+    expected = "".join(f"Rewriting {file}\n" for file in (files[2], files[0], files[1]))
+    assert capsys.readouterr().out == expected
+
+
+def test_cache(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    cache = Cache(tmp_path / "cache", Config(line_length=88))
+    assert not cache.is_clean(b"x = 1\n")
+    cache.mark_clean(b"x = 1\n")
+    assert cache.is_clean(b"x = 1\n")
+    assert not cache.is_clean(b"x = 2\n")
+    assert not Cache(tmp_path / "cache", Config(line_length=79)).is_clean(b"x = 1\n")
+
+    # a new version doesn't see, and prunes, the old version's entries
+    old_directory = cache.directory
+    monkeypatch.setattr("auto_walrus.__version__", "0.0.0")
+    cache = Cache(tmp_path / "cache", Config(line_length=88))
+    assert not cache.is_clean(b"x = 1\n")
+    cache.prune()
+    assert not old_directory.exists()
+
+
+def test_cache_shared_directory(
+    tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    # e.g. `--cache-dir .` in a project, or `--cache-dir ~/.cache`
+    (tmp_path / "src").mkdir()
+    (tmp_path / "src" / "a.py").write_text("x = 1\n")
+    (tmp_path / "other-tool").mkdir()
+    (tmp_path / ".gitignore").write_text("build/\n")
+    before = sorted(tmp_path.rglob("*"))
+    cache = Cache(tmp_path, Config(line_length=88))
+    cache.mark_clean(b"x = 1\n")
+    monkeypatch.setattr("auto_walrus.__version__", "0.0.0")
+    cache = Cache(tmp_path, Config(line_length=88))
+    cache.mark_clean(b"x = 1\n")
+    cache.prune(interval=0)
+    assert sorted(path.name for path in (tmp_path / "auto-walrus").iterdir()) == [
+        ".gitignore",
+        ".pruned",
+        "0.0.0",
+    ]
+    assert sorted(tmp_path.rglob("*")) == sorted(
+        [*before, *(tmp_path / "auto-walrus").rglob("*"), tmp_path / "auto-walrus"]
+    )
+    assert (tmp_path / ".gitignore").read_text() == "build/\n"
+
+
+def test_cache_prune(tmp_path: pathlib.Path) -> None:
+    cache = Cache(tmp_path / "cache", Config(line_length=88))
+    cache.prune()
+    for i in range(5):
+        cache.mark_clean(f"x = {i}\n".encode())
+    cache.prune(max_entries=3)
+    assert len(list(cache.directory.iterdir())) == 3
+    # the cache was just pruned, so it isn't listed again
+    cache.mark_clean(b"x = 5\n")
+    cache.prune(max_entries=3)
+    assert len(list(cache.directory.iterdir())) == 4
+    cache.prune(max_entries=3, interval=0)
+    assert len(list(cache.directory.iterdir())) == 3
+
+
+def test_main_with_cache(project_dir: ProjectDirT) -> None:
+    project_root, files = project_dir
+    cache_dir = project_root / ".auto_walrus_cache"
+    assert main(["--cache-dir", str(cache_dir), str(project_root)]) == 1
+    # the analysis of the functions of each file which was parsed, in an
+    # entry per file, and nothing else yet
+    version_dir = cache_dir / "auto-walrus" / auto_walrus_module.__version__
+    assert [path.name for path in version_dir.iterdir()] == ["functions"]
+    assert len(list(version_dir.glob("functions/*"))) == len(files)
+    # all files were rewritten, and are now remembered as clean
+    assert main(["--cache-dir", str(cache_dir), str(project_root)]) == 0
+    assert len([path for path in version_dir.iterdir() if path.is_file()]) == 1
+    files[0].write_text(SRC_ORIG)
+    assert main(["--cache-dir", str(cache_dir), str(project_root)]) == 1
+    assert files[0].read_text() == SRC_CHANGED
+    files[0].write_text(SRC_ORIG)
+    assert main(["--no-cache", "--cache-dir", str(cache_dir), str(project_root)]) == 1
+
+
+def test_verbose(project_dir: ProjectDirT, capsys: pytest.CaptureFixture[str]) -> None:
+    project_root, files = project_dir
+    files[0].write_text("x = 1\n")
+    main(["--verbose", str(project_root)])
+    assert capsys.readouterr().err == (
+        "3 file(s) checked, 1 skipped without parsing, 2 rewritten\n"
+    )
+
+
+def test_stats(project_dir: ProjectDirT, tmp_path: pathlib.Path) -> None:
+    project_root, files = project_dir
+    files[0].write_text("x = 1\n")
+    stats = Stats()
+    main(["--cache-dir", str(tmp_path / "cache"), str(project_root)], stats=stats)
+    assert stats.files_processed == 3
+    assert stats.files_cached == 0
+    assert stats.files_prefiltered == 1
+    assert stats.files_rewritten == 2
+    assert {"discover", "read", "prefilter", "parse", "analyse", "rewrite"} <= set(
+        stats.timings
+    )
+    assert sorted(path for _, path in stats.slowest) == sorted(map(str, files))
+
+    stats = Stats()
+    main(["--cache-dir", str(tmp_path / "cache"), str(project_root)], stats=stats)
+    # b.py and c.py now have the same content, so only one of them is parsed
+    assert stats.files_cached == 2
+    assert stats.files_rewritten == 0
+
+
+def test_stats_report(
+    project_dir: ProjectDirT,
+    capsys: pytest.CaptureFixture[str],
+) -> None:
+    project_root, files = project_dir
+    main(["--stats", str(project_root)])
+    err = capsys.readouterr().err
+    assert err.startswith(
+        "files: 3 processed, 0 cached, 0 skipped without parsing, 3 rewritten\n"
+        "time per phase:\n"
+    )
+    assert "  parse " in err
+    assert "slowest files:\n" in err
+    assert all(str(file) in err for file in files)
+
+
+def test_stats_slowest() -> None:
+    stats = Stats()
+    for i in range(20):
+        stats.add_file(float(i), f"{i}.py")
+    other = Stats(timings={"parse": 1.0}, files_processed=1)
+    other.add_file(100.0, "slow.py")
+    stats.merge(other)
+    stats.merge(other)
+    assert stats.timings == {"parse": 2.0}
+    assert stats.files_processed == 2
+    assert sorted(stats.slowest)[-3:] == [
+        (19.0, "19.py"),
+        (100.0, "slow.py"),
+        (100.0, "slow.py"),
+    ]
+    assert len(stats.slowest) == 10
+
+
+def test_profile(project_dir: ProjectDirT, tmp_path: pathlib.Path) -> None:
+    project_root, files = project_dir
+    profile = tmp_path / "out.prof"
+    main(["--profile", str(profile), "--jobs", "4", str(project_root)])
+    assert profile.is_file()
+    assert all(file.read_text() == SRC_CHANGED for file in files)
+
+
+def test_check(project_dir: ProjectDirT, capsys: pytest.CaptureFixture[str]) -> None:
+    project_root, files = project_dir
+    assert main(["--check", str(files[0])]) == 1
+    assert files[0].read_text() == SRC_ORIG
+    assert capsys.readouterr().out == f"Would rewrite {files[0]}\n"
+
+
+def test_diff(project_dir: ProjectDirT, capsys: pytest.CaptureFixture[str]) -> None:
+    project_root, files = project_dir
+    assert main(["--diff", str(files[0])]) == 1
+    assert files[0].read_text() == SRC_ORIG
+    assert capsys.readouterr().out == (
+        f"--- {files[0]}\n"
+        f"+++ {files[0]}\n"
+        "@@ -1,4 +1,3 @@\n"
+        " def foo():\n"
+        "-    a = 0\n"
+        "-    if a:\n"
+        "+    if (a := 0):\n"
+        "         print(a)\n"
+    )
+
+
+def test_diff_no_newline_at_end_of_file(
+    project_dir: ProjectDirT, capsys: pytest.CaptureFixture[str]
+) -> None:
+    project_root, files = project_dir
+    files[0].write_text(SRC_ORIG.rstrip("\n"))
+    assert main(["--diff", str(files[0])]) == 1
+    assert capsys.readouterr().out.endswith(
+        "         print(a)\n\\ No newline at end of file\n"
+    )
+
+
+def test_main_invalid(project_dir: ProjectDirT) -> None:
+    _, files = project_dir
+    invalid = "def foo():\n    a = 0\n    if a\n        print(a)\n"
+    files[0].write_text(invalid)
+    # the other files are still rewritten
+    assert main([str(file) for file in files]) == 1
+    assert [file.read_text() for file in files] == [invalid, SRC_CHANGED, SRC_CHANGED]
+
+
+def test_main_not_utf8(tmp_path: pathlib.Path) -> None:
+    path = tmp_path / "a.py"
+    data = b"# -*- coding: latin-1 -*-\n# caf\xe9\n" + SRC_ORIG.encode()
+    path.write_bytes(data)
+    assert main([str(path)]) == 0
+    assert path.read_bytes() == data
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="POSIX file modes")
+def test_main_keeps_file_mode(tmp_path: pathlib.Path) -> None:
+    path = tmp_path / "a.py"
+    path.write_text(SRC_ORIG)
+    path.chmod(0o751)
+    assert main([str(path)]) == 1
+    assert path.read_text() == SRC_CHANGED
+    assert path.stat().st_mode & 0o777 == 0o751
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def test_main_interrupted_write(
+    tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    path = tmp_path / "a.py"
+    path.write_text(SRC_ORIG)
+
+    def replace(*_args: str) -> None:
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr("os.replace", replace)
+    with pytest.raises(KeyboardInterrupt):
+        main([str(path)])
+    assert path.read_text() == SRC_ORIG
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def test_main_symlink(tmp_path: pathlib.Path) -> None:
+    (tmp_path / "src").mkdir()
+    target = tmp_path / "src" / "a.py"
+    target.write_text(SRC_ORIG)
+    target.chmod(0o640)
+    link = tmp_path / "link.py"
+    link.symlink_to(target)
+    assert main([str(link)]) == 1
+    # the link still points to the rewritten file
+    assert link.is_symlink()
+    assert target.read_text() == SRC_CHANGED
+    assert stat.S_IMODE(target.stat().st_mode) == 0o640
+    assert sorted(path.name for path in tmp_path.rglob("*")) == ["a.py", "link.py", "src"]
+
+
+@pytest.mark.parametrize(
+    ("argv", "newline"),
+    [([], "\r\n"), (["--stdin-filename", "a.py"], "\n")],
+)
+def test_main_stdin(
+    tmp_path: pathlib.Path,
+    monkeypatch: pytest.MonkeyPatch,
+    capsysbinary: pytest.CaptureFixture[bytes],
+    argv: list[str],
+    newline: str,
+) -> None:
+    monkeypatch.chdir(tmp_path)
+    data = SRC_ORIG.replace("\n", newline).encode()
+    monkeypatch.setattr("sys.stdin", io.TextIOWrapper(io.BytesIO(data)))
+    assert main(["-", "--files", r"\.py$", *argv]) == 0
+    assert capsysbinary.readouterr().out == SRC_CHANGED.replace("\n", newline).encode()
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.parametrize(
+    ("argv", "data"),
+    [
+        ([], "def foo(:\r\n"),
+        ([], "def foo():\n    a = 0\n    if a\n        print(a)\n"),
+        ([], "\xe9 = 0\n"),
+        (["--stdin-filename", "a.py", "--exclude", "a.py"], SRC_ORIG),
+        (["--stdin-filename", "a.pyi"], SRC_ORIG),
+        # excluded like the files which are found in directories
+        (["--stdin-filename", "build/a.py"], SRC_ORIG),
+        (["--stdin-filename", "venv/lib/a.py"], SRC_ORIG),
+    ],
+)
+def test_main_stdin_unchanged(
+    tmp_path: pathlib.Path,
+    monkeypatch: pytest.MonkeyPatch,
+    capsysbinary: pytest.CaptureFixture[bytes],
+    argv: list[str],
+    data: str,
+) -> None:
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr("sys.stdin", io.TextIOWrapper(io.BytesIO(data.encode("latin-1"))))
+    assert main(["-", "--files", r"\.py$", *argv]) == 0
+    assert capsysbinary.readouterr().out == data.encode("latin-1")
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.parametrize(
+    ("filename", "expected"),
+    [
+        ("sub/a.py", SRC_CHANGED),
+        ("sub/ignored.py", SRC_ORIG),
+        ("sub/generated/a.py", SRC_ORIG),
+        ("sub/generated/kept.py", SRC_CHANGED),
+        ("sub/skipped/a.py", SRC_ORIG),
+        # EXCLUDES apply from the repository's root
+        ("build/a.py", SRC_ORIG),
+    ],
+)
+def test_main_stdin_gitignore(
+    tmp_path: pathlib.Path,
+    monkeypatch: pytest.MonkeyPatch,
+    capsysbinary: pytest.CaptureFixture[bytes],
+    filename: str,
+    expected: str,
+) -> None:
+    (tmp_path / ".git").mkdir()
+    (tmp_path / ".gitignore").write_text("ignored.py\nskipped/\n")
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / ".gitignore").write_text("generated/*\n!generated/kept.py\n")
+    monkeypatch.chdir(tmp_path / "sub")
+    monkeypatch.setattr("sys.stdin", io.TextIOWrapper(io.BytesIO(SRC_ORIG.encode())))
+    assert main(["-", "--stdin-filename", str(tmp_path / filename)]) == 0
+    assert capsysbinary.readouterr().out == expected.encode()
+
+
+def test_main_stdin_config(
+    tmp_path: pathlib.Path,
+    monkeypatch: pytest.MonkeyPatch,
+    capsysbinary: pytest.CaptureFixture[bytes],
+) -> None:
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "pyproject.toml").write_text(
+        "[tool.auto-walrus]\nline-length = 10\n"
+    )
+    monkeypatch.setattr("sys.stdin", io.TextIOWrapper(io.BytesIO(SRC_ORIG.encode())))
+    filename = str(tmp_path / "sub" / "a.py")
+    assert main(["-", "--stats", "--stdin-filename", filename]) == 0
+    assert capsysbinary.readouterr().out == SRC_ORIG.encode()
+
+
+def test_main_stdin_diff(
+    monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture[str]
+) -> None:
+    monkeypatch.setattr("sys.stdin", io.TextIOWrapper(io.BytesIO(SRC_ORIG.encode())))
+    assert main(["-", "--diff", "--stdin-filename", "a.py"]) == 1
+    assert capsys.readouterr().out.startswith("--- a.py\n+++ a.py\n")
+    monkeypatch.setattr("sys.stdin", io.TextIOWrapper(io.BytesIO(SRC_ORIG.encode())))
+    assert main(["-", "--check"]) == 1
+    assert capsys.readouterr().out == "Would rewrite -\n"
+    monkeypatch.setattr("sys.stdin", io.TextIOWrapper(io.BytesIO(SRC_ORIG.encode())))
+    assert main(["-", "--format", "json"]) == 1
+    assert json.loads(capsys.readouterr().out)["path"] == "-"
+    monkeypatch.setattr("sys.stdin", io.TextIOWrapper(io.BytesIO(SRC_CHANGED.encode())))
+    assert main(["-", "--check"]) == 0
+    assert capsys.readouterr().out == ""
+
+
+@pytest.mark.parametrize(
+    "argv", [["-", "a.py"], ["-", "--staged"], ["-", "--changed-since", "HEAD"]]
+)
+def test_main_stdin_invalid(argv: list[str]) -> None:
+    with pytest.raises(SystemExit):
+        main(argv)
+
+
+# modules which `import auto_walrus` mustn't import, because most runs
+# don't need them
+LAZY_IMPORTS = (
+    "argparse",
+    "concurrent.futures",
+    "cProfile",
+    "difflib",
+    "hashlib",
+    "http.server",
+    "json",
+    "shutil",
+    "subprocess",
+    "tempfile",
+    "tomli",
+    "tomllib",
+    "urllib.request",
+)
+
+
+def test_lazy_imports() -> None:
+    # how long importing takes is measured by benchmarks/run.py instead, as
+    # timings are too noisy for the tests
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import auto_walrus"],
+        cwd=pathlib.Path(__file__).parent.parent,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stderr
+    # lines look like `import time:  self [us] | cumulative | module`
+    imported = {line.split("|")[-1].strip() for line in output.splitlines()[1:]}
+    assert "auto_walrus" in imported
+    assert imported.isdisjoint(LAZY_IMPORTS)
+
+
+def test_json(project_dir: ProjectDirT, capsys: pytest.CaptureFixture[str]) -> None:
+    project_root, files = project_dir
+    files[1].write_text(SRC_CHANGED)
+    assert main(["--check", "--format", "json", str(files[0]), str(files[1])]) == 1
+    (line,) = capsys.readouterr().out.splitlines()
+    assert json.loads(line) == {
+        "path": str(files[0]),
+        "rewrites": [
+            {
+                "name": "a",
+                "assignment": {
+                    "lineno": 2,
+                    "col_offset": 4,
+                    "end_lineno": 2,
+                    "end_col_offset": 9,
+                },
+                "if": {
+                    "lineno": 3,
+                    "col_offset": 7,
+                    "end_lineno": 3,
+                    "end_col_offset": 8,
+                },
+            },
+        ],
+    }
+
+    # with --diff, the diff is included
+    assert main(["--diff", "--format", "json", str(files[0])]) == 1
+    (line,) = capsys.readouterr().out.splitlines()
+    assert json.loads(line)["diff"].startswith(f"--- {files[0]}\n")
+
+
+def _git(cwd: pathlib.Path, *args: str) -> None:
+    subprocess.run(
+        ["git", "-c", "user.name=a", "-c", "user.email=a@b.c", *args],
+        cwd=cwd,
+        check=True,
+        capture_output=True,
+    )
+
+
+@pytest.mark.skipif(shutil.which("git") is None, reason="git is not installed")
+def test_changed_since(project_dir: ProjectDirT) -> None:
+    project_root, files = project_dir
+    _git(project_root, "init")
+    _git(project_root, "add", ".")
+    _git(project_root, "commit", "-m", "initial")
+    assert main(["--changed-since", "HEAD", str(project_root)]) == 0
+    assert files[0].read_text() == SRC_ORIG
+
+    files[0].write_text(SRC_ORIG + "\n")
+    untracked = project_root / "submodule3" / "d.py"
+    untracked.write_text(SRC_ORIG)
+    assert main(["--changed-since", "HEAD", str(project_root)]) == 1
+    assert files[0].read_text() == SRC_CHANGED + "\n"
+    assert untracked.read_text() == SRC_CHANGED
+    assert files[1].read_text() == SRC_ORIG
+    assert files[2].read_text() == SRC_ORIG
+
+
+@pytest.mark.skipif(shutil.which("git") is None, reason="git is not installed")
+def test_staged(project_dir: ProjectDirT) -> None:
+    project_root, files = project_dir
+    _git(project_root, "init")
+    _git(project_root, "add", str(files[1]))
+    assert main(["--staged", "--exclude", "/c", str(project_root)]) == 1
+    assert files[0].read_text() == SRC_ORIG
+    assert files[1].read_text() == SRC_CHANGED
+    assert files[2].read_text() == SRC_ORIG
+
+
+@pytest.mark.skipif(shutil.which("git") is None, reason="git is not installed")
+def test_staged_several_paths(project_dir: ProjectDirT) -> None:
+    project_root, files = project_dir
+    _git(project_root, "init")
+    _git(project_root, "add", ".")
+    # staged, then deleted
+    files[0].unlink()
+    argv = ["--staged", "--exclude", "/c", *(str(file.parent) for file in files[1:])]
+    assert main(argv) == 1
+    assert files[1].read_text() == SRC_CHANGED
+    # excluded
+    assert files[2].read_text() == SRC_ORIG
+
+
+def test_changed_since_not_a_repo(
+    tmp_path: pathlib.Path, capsys: pytest.CaptureFixture[str]
+) -> None:
+    with pytest.raises(SystemExit) as ei:
+        main(["--changed-since", "HEAD", str(tmp_path)])
+    assert ei.value.code == 2
+    assert "could not" in capsys.readouterr().err
+
+
+def test_staged_git_not_installed(
+    tmp_path: pathlib.Path,
+    capsys: pytest.CaptureFixture[str],
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    def git(*_args: str, **_kwargs: Any) -> str:
+        raise FileNotFoundError(2, "No such file or directory", "git")
+
+    monkeypatch.setattr("auto_walrus._git", git)
+    with pytest.raises(SystemExit) as ei:
+        main(["--staged", str(tmp_path)])
+    assert ei.value.code == 2
+    assert "could not run git" in capsys.readouterr().err
+
+
+@pytest.mark.parametrize(
+    ("pattern", "path", "is_dir", "expected"),
+    [
+        ("*.py", "/r/a.py", False, True),
+        ("*.py", "/r/x/a.py", False, True),
+        ("*.py", "/r/a.pyc", False, None),
+        ("x/*.py", "/r/x/a.py", False, True),
+        ("x/*.py", "/r/y/x/a.py", False, None),
+        ("/a.py", "/r/x/a.py", False, None),
+        ("build/", "/r/x/build", True, True),
+        ("build/", "/r/x/build", False, None),
+        ("**/build", "/r/x/build", True, True),
+        ("x/**/a.py", "/r/x/a.py", False, True),
+        ("x/**/a.py", "/r/x/y/z/a.py", False, True),
+        ("x/**", "/r/x/y/a.py", False, True),
+        ("a?.py", "/r/ab.py", False, True),
+        ("a[bc].py", "/r/ac.py", False, True),
+        ("a[!bc].py", "/r/ac.py", False, None),
+        ("\\#a.py", "/r/#a.py", False, True),
+        ("# comment", "/r/# comment", False, None),
+        ("*.py\n!b.py", "/r/b.py", False, False),
+        ("a.py\\ ", "/r/a.py ", False, True),
+        ("a.py  ", "/r/a.py", False, True),
+        ("/", "/r/a.py", False, None),
+        ("*.py", "/s/a.py", False, None),
+    ],
+)
+def test_gitignore(
+    pattern: str,
+    path: str,
+    *,
+    is_dir: bool,
+    expected: bool | None,
+) -> None:
+    assert GitIgnore("/r", pattern.splitlines()).match(path, is_dir=is_dir) is expected
+
+
+def test_gitignore_respected(project_dir: ProjectDirT) -> None:
+    project_root, files = project_dir
+    (project_root / ".gitignore").write_text("submodule3/\n/submodule1/b.py\n")
+    main([str(project_root), str(files[1])])
+    # explicitly passed files are always processed
+    expected = [SRC_CHANGED, SRC_CHANGED, SRC_ORIG]
+    assert [file.read_text() for file in files] == expected
+
+
+@pytest.mark.parametrize("is_repository", [True, False])
+def test_enclosing_gitignore(project_dir: ProjectDirT, *, is_repository: bool) -> None:
+    project_root, files = project_dir
+    (project_root / ".gitignore").write_text("submodule2/\n")
+    if is_repository:
+        (project_root / ".git").mkdir()
+    main([str(project_root / "submodule1")])
+    expected = SRC_ORIG if is_repository else SRC_CHANGED
+    assert files[0].read_text() == expected
+    assert files[1].read_text() == SRC_CHANGED
+
+
+def test_excluded_directories(project_dir: ProjectDirT) -> None:
+    project_root, files = project_dir
+    excluded = [
+        project_root / "submodule1" / "build" / "d.py",
+        project_root / "build" / "e.py",
+        project_root / ".venv" / "f.py",
+    ]
+    for file in excluded:
+        file.parent.mkdir()
+        file.write_text(SRC_ORIG)
+    main([str(project_root)])
+    assert [file.read_text() for file in excluded] == [SRC_ORIG] * 3
+
+
+def test_unreadable_directory(
+    project_dir: ProjectDirT,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    project_root, files = project_dir
+    scandir = os.scandir
+
+    def scandir_or_fail(path: str) -> Iterator[os.DirEntry[str]]:
+        if pathlib.Path(path).name == "submodule3":
+            raise PermissionError(path)
+        return scandir(path)
+
+    monkeypatch.setattr("os.scandir", scandir_or_fail)
+    main([str(project_root)])
+    # the directory which can't be listed is skipped
+    assert [file.read_text() for file in files] == [SRC_CHANGED, SRC_CHANGED, SRC_ORIG]
+
+
+@pytest.mark.parametrize(("jobs", "max_in_flight"), [(1, None), (2, None), (2, 2)])
+def test_auto_walrus_many(jobs: int, max_in_flight: int | None) -> None:
+    items = [
+        ("changed", SRC_ORIG),
+        ("unchanged", "x = 1\n"),
+        ("invalid", "def foo():\n    a = 0\n    if a\n        print(a)\n"),
+        ("invalid without candidates", "def foo(:\n"),
+        ("null byte", "x = 1\0\n"),
+    ] * 5
+    results = list(
+        auto_walrus_many(
+            items,
+            Config(line_length=88),
+            jobs=jobs,
+            max_in_flight=max_in_flight,
+        )
+    )
+    assert [key for key, _ in results] == [key for key, _ in items]
+    assert results[0] == ("changed", SRC_CHANGED)
+    assert results[1] == ("unchanged", None)
+    assert results[2][0] == "invalid"
+    assert isinstance(results[2][1], SyntaxError)
+    assert isinstance(results[3][1], SyntaxError)
+    # a SyntaxError since Python 3.12
+    assert isinstance(results[4][1], (SyntaxError, ValueError))
+
+
+def test_auto_walrus_many_is_lazy() -> None:
+    def items() -> Iterator[tuple[int, str]]:
+        yield 0, SRC_ORIG
+        raise AssertionError("consumed too eagerly")
+
+    results = auto_walrus_many(items(), Config(line_length=88))
+    assert next(results) == (0, SRC_CHANGED)
+
+
+@contextlib.contextmanager
+def running_daemon(*, verbose: bool = False) -> Iterator[str]:
+    server = DaemonServer(("127.0.0.1", 0), verbose=verbose)
+    thread = threading.Thread(target=server.serve_forever, args=(0.01,))
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_port}/"
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+@pytest.fixture
+def daemon_url() -> Iterator[str]:
+    with running_daemon() as url:
+        yield url
+
+
+@pytest.mark.parametrize(
+    ("src", "expected"),
+    [
+        (SRC_ORIG, SRC_CHANGED),
+        ("x = 1\n", None),
+        ("def foo():\n    a = 0\n    if a\n        print(a)\n", None),
+    ],
+)
+def test_daemon(daemon_url: str, src: str, expected: str | None) -> None:
+    assert auto_walrus_daemon(src, Config(line_length=88), url=daemon_url) == expected
+
+
+@pytest.mark.parametrize("verbose", [True, False])
+def test_daemon_verbose(*, verbose: bool, capsys: pytest.CaptureFixture[str]) -> None:
+    with running_daemon(verbose=verbose) as url:
+        assert auto_walrus_daemon(SRC_ORIG, Config(line_length=88), url=url) == (
+            SRC_CHANGED
+        )
+    # requests are only logged in verbose mode
+    assert ('"POST / HTTP/1.1" 200' in capsys.readouterr().err) is verbose
+
+
+def test_daemon_classes() -> None:
+    assert issubclass(
+        auto_walrus_module.DaemonHandler, http.server.BaseHTTPRequestHandler
+    )
+    with pytest.raises(AttributeError, match="DaemonClient"):
+        auto_walrus_module.DaemonClient  # noqa: B018
+
+
+def test_daemon_config(daemon_url: str) -> None:
+    src = "def foo():\n    if True:\n        a = 0\n        if a:\n            print(a)\n"
+    assert auto_walrus_daemon(src, Config(line_length=88), url=daemon_url) is None
+    assert (
+        auto_walrus_daemon(src, Config(line_length=88, unsafe=True), url=daemon_url)
+        == "def foo():\n    if True:\n        if (a := 0):\n            print(a)\n"
+    )
+    assert auto_walrus_daemon(SRC_ORIG, Config(line_length=10), url=daemon_url) is None
+
+
+@pytest.mark.parametrize(
+    "headers",
+    [
+        {},
+        {"X-Auto-Walrus-Line-Length": "eighty"},
+        {"X-Auto-Walrus-Line-Length": "88", "X-Auto-Walrus-Unsafe": "maybe"},
+    ],
+)
+def test_daemon_invalid_config(daemon_url: str, headers: dict[str, str]) -> None:
+    request = urllib.request.Request(
+        daemon_url, data=SRC_ORIG.encode(), headers=headers, method="POST"
+    )
+    with pytest.raises(urllib.error.HTTPError) as exc_info:
+        urllib.request.urlopen(request)
+    assert exc_info.value.code == 400
+    exc_info.value.close()
+
+
+def test_daemon_optional_headers(daemon_url: str) -> None:
+    request = urllib.request.Request(
+        daemon_url,
+        data=SRC_ORIG.encode(),
+        headers={"X-Auto-Walrus-Line-Length": "88"},
+        method="POST",
+    )
+    with urllib.request.urlopen(request) as response:
+        assert response.status == 200
+        assert response.read().decode() == SRC_CHANGED
+
+
+def unused_url() -> str:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    return f"http://127.0.0.1:{port}/"
+
+
+def test_daemon_not_running() -> None:
+    # nothing is listening, so this falls back to running in-process
+    assert auto_walrus_daemon(SRC_ORIG, Config(line_length=88), url=unused_url()) == (
+        SRC_CHANGED
+    )
+
+
+NESTED_SRC = (
+    "def foo():\n    if True:\n        a = 0\n        if a:\n            print(a)\n"
+)
+NESTED_SRC_CHANGED = (
+    "def foo():\n    if True:\n        if (a := 0):\n            print(a)\n"
+)
+
+
+@pytest.mark.parametrize("running", [True, False])
+@pytest.mark.parametrize(
+    ("argv", "data", "expected", "expected_returncode"),
+    [
+        ([], SRC_ORIG.encode(), SRC_CHANGED.encode(), 0),
+        ([], b"x = 1\n", b"x = 1\n", 0),
+        (["--line-length", "10"], SRC_ORIG.encode(), SRC_ORIG.encode(), 0),
+        ([], NESTED_SRC.encode(), NESTED_SRC.encode(), 0),
+        (["--unsafe"], NESTED_SRC.encode(), NESTED_SRC_CHANGED.encode(), 0),
+        # invalid sources are written back unchanged
+        (
+            [],
+            b"def foo():\n    a = 0\n    if a\n",
+            b"def foo():\n    a = 0\n    if a\n",
+            1,
+        ),
+        ([], b"x = '\xe9'\n", b"x = '\xe9'\n", 1),
+    ],
+)
+def test_client(  # noqa: PLR0913
+    *,
+    daemon_url: str,
+    running: bool,
+    argv: list[str],
+    data: bytes,
+    expected: bytes,
+    expected_returncode: int,
+    monkeypatch: pytest.MonkeyPatch,
+    capsysbinary: pytest.CaptureFixture[bytes],
+) -> None:
+    monkeypatch.setattr("sys.stdin", io.TextIOWrapper(io.BytesIO(data)))
+    url = daemon_url if running else unused_url()
+    assert auto_walrus_client.main(["--url", url, *argv]) == expected_returncode
+    out, err = capsysbinary.readouterr()
+    assert out == expected
+    assert bool(err) == bool(expected_returncode)
+
+
+def test_client_flags() -> None:
+    flags = tuple(
+        field.name for field in dataclasses.fields(Config) if field.type == "bool"
+    )
+    assert flags == auto_walrus_client.FLAGS
+
+
+def test_client_import() -> None:
+    # the client only needs auto_walrus itself if no daemon is running
+    subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, auto_walrus_client; assert 'auto_walrus' not in sys.modules",
+        ],
+        cwd=pathlib.Path(__file__).parent.parent,
+        check=True,
+    )
@@ -20,6 +20,15 @@ content = content.replace(f'version = "{old_version}"', f'version = "{version}"'
 with open("pyproject.toml", "w", encoding="utf-8") as f:
     f.write(content)
 
+with open("auto_walrus.py", encoding="utf-8") as f:
+    content = f.read()
+content = content.replace(
+    f'__version__ = "{old_version}"',
+    f'__version__ = "{version}"',
+)
+with open("auto_walrus.py", "w", encoding="utf-8") as f:
+    f.write(content)
+
 with open("README.md", encoding="utf-8") as f:
     content = f.read()
 content = content.replace(